@@ -1,15 +1,25 @@
 '''The flask app is built here'''
 
-from flask import Flask
+import atexit
+from time import perf_counter
+from flask import Flask, g, request
 from flask_restful import Api
 from .plugins import mongo, redis_client
+from .app.v1.controllers import ForgeWorker, ControllerContainer
+from .app.v1 import metrics, tracing
 from . import configs
 from .app.v1.blueprint import v1_bp
 from .app.v1.resources import (SystemResource,
                                BlockResources,
                                NodeResources,
                                BlockResource,
-                               BlockResourcesDemo)
+                               BlockResourcesDemo,
+                               NewBlockResource,
+                               BlockRangeResource,
+                               BlockHashResource,
+                               PlotProofResource,
+                               PlotHistoryResource,
+                               MetricsResource)
 
 # Use the dev/testing or production configs
 if configs.testing:
@@ -33,6 +43,9 @@ def create_app(config_object=app_configs):
     mongo.init_app(app)
     redis_client.init_app(app)
 
+    # Share the controllers across requests, bootstrapped on first use
+    app.extensions['controllers'] = ControllerContainer()
+
     # Register all app components in the app context
     with app.app_context():
 
@@ -40,13 +53,71 @@ def create_app(config_object=app_configs):
         api_v1 = Api(v1_bp)
         api_v1.add_resource(SystemResource, '/init')
         api_v1.add_resource(BlockResource, '/block')
+        api_v1.add_resource(BlockHashResource, '/block/<string:block_hash>')
         api_v1.add_resource(BlockResources, '/blocks')
+        api_v1.add_resource(NewBlockResource, '/blocks/new')
+        api_v1.add_resource(BlockRangeResource, '/blocks/range')
         api_v1.add_resource(NodeResources, '/nodes')
         api_v1.add_resource(BlockResourcesDemo, '/blockchain')
+        api_v1.add_resource(PlotProofResource,
+                            '/plots/<string:plot_num>/proof')
+        api_v1.add_resource(PlotHistoryResource,
+                            '/plots/<string:plot_num>/history')
+        api_v1.add_resource(MetricsResource, '/metrics')
 
         # Register app blueprints
         app.register_blueprint(v1_bp, url_prefix='/backend/v1')
 
+    # Write logs and traces from a background thread
+    tracing.configure_logging()
+
+    # Trace every request and record its latency
+    @app.before_request
+    def start_request_span():
+        '''Starts the request's span -> None'''
+
+        g.request_start = perf_counter()
+        g.request_span = tracing.start_span(
+            'request', root=True, method=request.method, path=request.path)
+
+    @app.after_request
+    def record_request_latency(response):
+        '''Records the request's latency per resource -> response'''
+
+        if 'request_start' in g:
+            metrics.REQUESTS.observe(
+                perf_counter() - g.request_start,
+                endpoint=request.endpoint or 'none', method=request.method,
+                status=response.status_code)
+            g.request_span.set(status=response.status_code)
+
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc):
+        '''Ends the request's span, logging its trace -> None'''
+
+        if 'request_span' in g:
+            tracing.end_span(g.pop('request_span'))
+
+    # Forge queued transactions on this process' forge worker. Tests forge
+    # blocks directly, so the worker is not started when testing.
+    if not configs.testing:
+
+        @app.before_request
+        def start_forge_worker():
+            '''Starts the forge worker in forked server processes -> None'''
+
+            ForgeWorker.get_worker(app).start()
+
+        @atexit.register
+        def stop_forge_worker():
+            '''Lets the block being forged complete on shutdown -> None'''
+
+            ForgeWorker.get_worker(app).stop(timeout=30)
+
+        start_forge_worker()
+
     return app
 
 
@@ -9,15 +9,65 @@ This interfacing module:
 '''
 
 import json
+import math
 import requests
 import hashlib
-from threading import Timer
-from flask import request
+import hmac
+from requests.adapters import HTTPAdapter
+from collections import deque, OrderedDict
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait)
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import Array
+from os import getpid
+from threading import Thread, Event, Lock, RLock
+from flask import request, current_app
+from contextlib import contextmanager
 from datetime import date, datetime
+from time import time, monotonic
 from uuid import uuid4
-from pathlib import Path
-from ...configs import secret_key, init_node, public_ip, port, fe_host, testing
-from .models import BlockModel, NodeModel, BlockCacheModel
+from pymongo.errors import DuplicateKeyError
+from ...configs import (secret_key, init_node, public_ip, port, fe_host,
+                        pow_workers, pow_chunk_size, pow_kernel,
+                        pow_difficulty, pow_min_difficulty,
+                        pow_retarget_interval, pow_retarget_height,
+                        pow_target_block_time,
+                        forge_batch_size, forge_batch_wait,
+                        peer_connect_timeout, peer_read_timeout,
+                        peer_deadline, peer_pool_size, compression_level,
+                        stream_batch_size)
+from .models import BlockModel, NodeModel, BlockCacheModel, PlotHistoryModel
+from . import wire, metrics, tracing, pow_kernels
+from .tracing import logger
+
+
+def block_transactions(block):
+    '''Returns the transactions in a block, which holds either a single
+    'transaction' or a batch of 'transactions' -> list'''
+
+    if 'transactions' in block:
+        return block['transactions']
+
+    return [block['transaction']]
+
+
+@contextmanager
+def forge_phase(phase):
+    '''Times a phase of a block forge, as a span of the forge's trace and
+    in the forge phase metrics -> context manager of the Span'''
+
+    with tracing.span(phase) as span, metrics.FORGE_PHASES.time(phase=phase):
+        yield span
+
+
+def transaction_plots(transaction):
+    '''Returns the plot number(s) of a transaction or batch of transactions
+    forged into a block, as reported to the frontend -> str'''
+
+    if isinstance(transaction, list):
+        return ', '.join(str(record.get('plot_num')) for record in transaction)
+
+    return transaction.get("plot_num", None)
 
 
 class CacheController:
@@ -27,51 +77,191 @@ class CacheController:
         '''Initializes the cache controller'''
 
         self.cache_db = BlockCacheModel()
-        self.fetch_new_transactions()
+        self.blockchain_db = BlockModel()
+
+    def update_blockchain_cache(self, records=None):
+        '''
+        Formats blockchain data before adding to redis cache -> None
+            1. If param[records] is None, only the blocks forged since the
+            last cached block are added (delta update).
+            2. All records are written in one pipelined round trip, together
+            with the index of the last cached block.
+        '''
+
+        with metrics.CACHE_UPDATES.time():
+            if records is None:
+                records = self.blockchain_db.get_blocks_since(
+                    self.cache_db.get_cache_tip())
 
-    def update_blockchain_cache(self, records):
-        '''Formats blockchain data before adding to redis cache -> None'''
+            cache_data, tip_index = {}, None
 
-        if records:
             for record in records:
-                data = {
-                    'PlotNumber': '',
-                    'OwnerName': record['transaction']['buyer_name'],
-                    'OwnerID': record['transaction']['buyer_id'],
-                    'OwnerTel': record['transaction']['buyer_tel'],
-                    'County': record['transaction']['county'],
-                    'Location': record['transaction']['location'],
-                    'Size(Acres)': record['transaction']['size'],
-                    'RecordedOn': record['date']
-                    }
+                cache_data.update(self.block_records(record))
+                tip_index = record['index']
 
+            if tip_index is not None:
                 self.cache_db.push_to_cache(
-                    record['transaction']['plot_num'], json.dumps(data))
+                    cache_data, tip_index,
+                    tip_hash=self.blockchain_db.get_block_hash(tip_index))
+
+    def block_records(self, block):
+        '''Returns the cached records {plot_num: record} of a block's
+        transactions -> dict'''
+
+        return {
+            transaction['plot_num']: self.format_record(
+                transaction, block['date'])
+            for transaction in block_transactions(block)
+            if 'plot_num' in transaction
+        }
+
+    def warm_start(self, tip):
+        '''
+        Brings the redis cache up to date with our chain's param[tip] on
+        startup -> str, 'current', 'replayed' or 'rebuilt'
+            1. A cache of our tip block (same index and hash) is kept as is.
+            2. A cache of an earlier block of our chain only gets the blocks
+            after it (delta update).
+            3. Otherwise (a flushed cache, or a cached block that has since
+            been replaced) the cache is rebuilt from the chain cursor, in
+            batches of STREAM_BATCH_SIZE records (see
+            BlockCacheModel.rebuild_cache).
+        '''
+
+        if tip is None:
+            return 'current'
+
+        cache_index, cache_hash = self.cache_db.get_cache_state()
+
+        if cache_hash is not None and cache_index == tip['index'] and \
+                cache_hash == tip['hash']:
+            return 'current'
+
+        if cache_hash is not None and cache_index < tip['index'] and \
+                self.blockchain_db.get_block_hash(cache_index) == cache_hash:
+            self.update_blockchain_cache()
+            return 'replayed'
+
+        def batches():
+            batch = {}
+
+            for block in self.blockchain_db.get_chain(
+                    batch_size=stream_batch_size):
+                batch.update(self.block_records(block))
+
+                if len(batch) >= stream_batch_size:
+                    yield batch
+                    batch = {}
+
+            if batch:
+                yield batch
+
+        self.cache_db.rebuild_cache(batches(), tip['index'], tip['hash'])
+        return 'rebuilt'
+
+    def format_record(self, transaction, recorded_on):
+        '''Formats a block's transaction as a cached record -> str'''
+
+        data = {
+            'PlotNumber': '',
+            'OwnerName': transaction['buyer_name'],
+            'OwnerID': transaction['buyer_id'],
+            'OwnerTel': transaction['buyer_tel'],
+            'County': transaction['county'],
+            'Location': transaction['location'],
+            'Size(Acres)': transaction['size'],
+            'RecordedOn': recorded_on
+        }
+
+        return json.dumps(data)
+
+    def rewind_blockchain_cache(self, fork_index, removed_blocks):
+        '''
+        Rewinds the redis cache to the block at param[fork_index], after the
+        blocks following it were replaced -> None
+            1. Records of plots in param[removed_blocks] are restored to
+            their last transaction up to the fork, or removed if none.
+            2. The new blocks are then added with a delta update.
+        '''
+
+        restored, removed = {}, []
+        plots = {transaction['plot_num'] for block in removed_blocks
+                 for transaction in block_transactions(block)
+                 if 'plot_num' in transaction}
+
+        for plot_num in plots:
+            record = self.blockchain_db.get_last_plot_block(
+                plot_num, fork_index)
+
+            if record is None:
+                removed.append(plot_num)
+                continue
+
+            # The plot's last transaction in its last block
+            for transaction in block_transactions(record):
+                if transaction.get('plot_num') == plot_num:
+                    restored[plot_num] = self.format_record(
+                        transaction, record['date'])
+
+        self.cache_db.push_to_cache(
+            restored, max(fork_index, 1), removed_fields=removed,
+            tip_hash=self.blockchain_db.get_block_hash(max(fork_index, 1)))
+        self.update_blockchain_cache()
 
     def fetch_new_transactions(self):
         '''Gets new transactions to forge into blocks from Redis
-        queue -> None'''
+        queue, up to FORGE_BATCH_SIZE transactions per block. Blocks for up
+        to 2s while the queue is empty -> dict or None if none were queued'''
 
-        transactions = self.cache_db.pop_from_queue()
+        transactions = self.cache_db.pop_from_queue(
+            batch_size=forge_batch_size, batch_wait=forge_batch_wait)
 
         if len(transactions) != 0:
-            for transaction in transactions:
-                record = json.loads(transaction[1].decode('utf-8'))
-                result = BlockController().forge_block(transaction=record)
-                requests.post(f'http://{fe_host}:3000/alerts', data=result)
-        else:
-            if testing:
-                return
-            else:
-                print('Waiting for transactions...')
+            records = [json.loads(transaction.decode('utf-8'))
+                       for transaction in transactions]
+            blocks = get_controllers().blocks
+
+            # Transactions on a plot already in the batch wait for the next
+            records, forge_later, dropped = blocks.split_batch(records)
+
+            if forge_later:
+                self.reset_failed_forge(forge_later)
+
+            # Dropped transactions are reported as failed forges
+            if dropped:
+                self.send_alert({'failure': transaction_plots(dropped)})
 
-        Timer(5.0, self.fetch_new_transactions).start()
+            if not records:
+                return None
+
+            # A batch of transactions is forged into a single block
+            result = blocks.forge_block(
+                transaction=records if len(records) > 1 else records[0])
+            self.send_alert(result)
+
+            return result
+
+    def send_alert(self, result):
+        '''Reports a forge's param[result] to the frontend -> None'''
+
+        try:
+            requests.post(
+                f'http://{fe_host}:3000/alerts', data=result,
+                timeout=(peer_connect_timeout, peer_read_timeout))
+
+        except requests.exceptions.RequestException as err:
+            # The block is forged even if the frontend misses the alert
+            logger.warning('Alert failed: %s', err)
 
     def reset_failed_forge(self, failed_transaction):
-        '''Re-queues a failed transaction forge for another automatic
-        re-forge attempt -> None'''
+        '''Re-queues a failed transaction (or batch of transactions) forge
+        for another automatic re-forge attempt -> None'''
 
-        self.cache_db.push_to_queue(json.dumps(failed_transaction))
+        if isinstance(failed_transaction, list):
+            self.cache_db.push_to_queue(
+                *[json.dumps(record) for record in failed_transaction])
+        else:
+            self.cache_db.push_to_queue(json.dumps(failed_transaction))
 
     def check_pending_transactions(self):
         '''Checks if the redis queue has no pending transactions that
@@ -80,18 +270,135 @@ class CacheController:
         return self.cache_db.pop_from_queue(length=True)
 
 
+class ForgeWorker:
+    '''
+    Forges queued transactions into blocks on a single long-lived thread
+    per process
+        1. The worker is kept in app.extensions and started once per
+        process (forked server workers each start their own).
+        2. It blocks on the Redis queue, so queued transactions are forged
+        as soon as they arrive.
+        3. Stopping it lets the block being forged complete first.
+    '''
+
+    _lock = Lock()
+
+    def __init__(self, app):
+        '''Initializes the worker's state for param[app]'''
+
+        self.app = app
+        self.pid = getpid()
+        self.started_at = None
+        self.forged_blocks = 0
+        self.failed_forges = 0
+        self.last_forge = None
+        self.last_error = None
+        self._stopping = Event()
+        self._thread = None
+
+    @classmethod
+    def get_worker(cls, app):
+        '''Returns this process' forge worker for param[app], creating it
+        on first use -> ForgeWorker'''
+
+        with cls._lock:
+            worker = app.extensions.get('forge_worker')
+
+            if worker is None or worker.pid != getpid():
+                worker = cls(app)
+                app.extensions['forge_worker'] = worker
+
+        return worker
+
+    @property
+    def running(self):
+        '''Checks if the worker thread is alive -> Boolean'''
+
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        '''Starts the worker thread, if it is not already running -> None'''
+
+        with ForgeWorker._lock:
+            if self.running:
+                return
+
+            self._stopping.clear()
+            self._thread = Thread(
+                target=self.run, name='forge-worker', daemon=True)
+            self._thread.start()
+            self.started_at = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+
+    def stop(self, timeout=None):
+        '''Stops the worker once its current forge completes, waiting up to
+        param[timeout] seconds for it to exit -> None'''
+
+        self._stopping.set()
+
+        if self.running:
+            self._thread.join(timeout)
+
+    def run(self):
+        '''Forges queued transactions until the worker is stopped -> None'''
+
+        with self.app.app_context():
+            while not self._stopping.is_set():
+                try:
+                    result = get_controllers(
+                        self.app).cache.fetch_new_transactions()
+
+                except Exception as err:
+                    # Back off, so that a failing datastore is not hammered
+                    self.last_error = repr(err)
+                    self._stopping.wait(1.0)
+                    continue
+
+                if result is None:
+                    continue
+
+                self.last_forge = result
+
+                if 'success' in result:
+                    self.forged_blocks += 1
+                else:
+                    # The transactions were re-queued, retry them later
+                    self.failed_forges += 1
+                    self._stopping.wait(5.0)
+
+    def state(self):
+        '''Returns the worker's state -> dict'''
+
+        return {
+            'running': self.running,
+            'pid': self.pid,
+            'started_at': self.started_at,
+            'forged_blocks': self.forged_blocks,
+            'failed_forges': self.failed_forges,
+            'last_forge': self.last_forge,
+            'last_error': self.last_error,
+            'queued_transactions': BlockCacheModel().pop_from_queue(
+                length=True)
+        }
+
+
 class BlockController:
     '''Manages block forging and access to the blockchain'''
 
     pending_transactions = False
 
-    def __init__(self):
-        '''Initializes this node with a seed block'''
+    def __init__(self, cache_controller=None, node_controller=None,
+                 net_controller=None):
+        '''Initializes the block controller, sharing the given controllers'''
 
         self.blockchain_db = BlockModel()
-        self.cache_controller = CacheController()
-        self.node_controller = NodeController()
-        self.net_controller = NetworkController()
+        self.history_db = PlotHistoryModel()
+        self.cache_controller = cache_controller or CacheController()
+        self.node_controller = node_controller or NodeController()
+        self.net_controller = net_controller or NetworkController()
+
+    def seed_chain(self):
+        '''Initializes this node's blockchain with a seed block, unless it
+        has peers to sync with or already has a chain -> None'''
 
         if not self.node_controller.extract_nodes() and \
                 self.blockchain_db.get_chain(True) == 0:
@@ -99,6 +406,7 @@ class BlockController:
                              transaction={
                                  'seed_block': 'blockchain_initialized'})
 
+    @tracing.traced('forge_block')
     def forge_block(self, proof=None, previous_hash=None,
                     index=None, transaction=None):
 
@@ -110,9 +418,11 @@ class BlockController:
             transactions details in Redis and trying sync again after a
             while. If all these pass, then a new block for the new
             transaction is forged.
-        2. Proof (int) is the proof computed by the proof of work algorithm.
-        3. Previous_hash (str) is the previous block hash.
-        4. Sync_result can be:
+        2. Transaction (dict) is the block's transaction, or a list of
+            transactions forged into a single block from a batch.
+        3. Proof (int) is the proof computed by the proof of work algorithm.
+        4. Previous_hash (str) is the previous block hash.
+        5. Sync_result can be:
             (a) error_node list => stop blog forging until no error_nodes
             are returned
             (b) None => sync was successful with all registered node or
@@ -120,78 +430,162 @@ class BlockController:
             (new transaction or seed block)
         '''
 
+        forge_span = tracing.current_span()
+
         # Update the blockchain from other peer nodes
-        sync_result = self.sync(update_chain=True)
-        curr_time = datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+        with forge_phase('sync'):
+            sync_result = self.sync(update_chain=True)
 
         if sync_result and index is None:
             self.cache_controller.reset_failed_forge(transaction)
             BlockController.pending_transactions = True
 
-            logs_file = open(Path.cwd()/'backend_logs', 'a')
-
             if isinstance(sync_result['sync_error'], list):
                 for err in sync_result['sync_error']:
-                    logs_file.write(f"[{curr_time}] {err['message']}\n")
+                    logger.warning('%s', err['message'])
             else:
-                logs_file.write(f"[{curr_time}] {sync_result['sync_error']}\n")
+                logger.warning('%s', sync_result['sync_error'])
 
-            logs_file.close()
+            forge_span.set(result='sync_error')
+            metrics.FORGES.inc(result='failure')
 
-            return {'failure': transaction.get("plot_num", None)}
+            return {'failure': transaction_plots(transaction)}
 
         # Forge block and add it to our blockchain
         security = SecurityController()
-        last_block = self.blockchain_db.get_last_block()
+        tip = self.chain_tip()
+
+        difficulty = security.next_difficulty(
+            tip, self.blockchain_db.get_block)
+
+        with forge_phase('pow'):
+            proof = proof or security.proof_of_work(
+                tip['proof'], difficulty=difficulty)
 
         block = {
-            'index': index or (last_block['index'] + 1),
+            'index': index or (tip['index'] + 1),
             'date': str(date.today()),
-            'transaction': transaction,
-            'proof': proof or security.proof_of_work(last_block['proof']),
-            'previous_hash': previous_hash or security.hash_block(last_block)
+            'timestamp': round(time(), 3),
+            'difficulty': difficulty,
+            'proof': proof,
+            'previous_hash': previous_hash or tip['hash']
         }
-        self.blockchain_db.persist_new_block(block)
 
-        # Remove seed block from blockchain & add the rest to Redis cache
-        blockchain = self.extract_chain()
-        self.cache_controller.update_blockchain_cache(blockchain[1:])
+        if isinstance(transaction, list):
+            block['transactions'] = transaction
+        else:
+            block['transaction'] = transaction
+
+        block['merkle_root'] = security.merkle_root(block_transactions(block))
+        block_hash = security.hash_block(block)
+
+        forge_span.set(index=block['index'])
+
+        try:
+            with forge_phase('persist'):
+                self.blockchain_db.persist_new_block(block, block_hash)
+
+        except DuplicateKeyError:
+            # A block was added at this index while forging, retry later
+            self.cache_controller.reset_failed_forge(transaction)
+            forge_span.set(result='duplicate_index')
+            metrics.FORGES.inc(result='failure')
+            return {'failure': transaction_plots(transaction)}
+
+        security.checkpoint_block(block, block_hash)
+
+        # Add the blocks forged since the last cached block to Redis cache
+        with forge_phase('cache'):
+            self.cache_controller.update_blockchain_cache()
+            self.update_plot_history()
 
         # Ensure that all pending transactions have been forged
         if self.cache_controller.check_pending_transactions() == 0:
             BlockController.pending_transactions = False
 
-            # Send updated blockchain to all peers to update theirs
+            # Send the new block to all peers to append to their chains
             nodes = self.node_controller.extract_nodes()
             if nodes:
-                err_res = self.net_controller.send_data(nodes, blockchain)
+                with forge_phase('broadcast') as broadcast_span:
+                    err_res = self.net_controller.send_data(
+                        nodes, block, endpoint='blocks/new')
+                    broadcast_span.set(peers=len(nodes))
 
                 # Log update responses from peer hubs
-                logs_file = open(Path.cwd()/'backend_logs', 'a')
+                for msg in err_res['update_error_nodes']:
+                    logger.warning('%s', msg['message'])
+
+        forge_span.set(result='success')
+        metrics.FORGES.inc(result='success')
+
+        return {'success': transaction_plots(transaction)}
+
+    def chain_tip(self):
+        '''Returns the tip record {index, hash, proof} of our last block,
+        recording it first for chains saved before tip records -> dict or
+        None if the chain is empty'''
 
-                if err_res:
-                    for msg in err_res['update_error_nodes']:
-                        logs_file.write(f"[{curr_time}] {msg['message']}\n")
+        tip = self.blockchain_db.get_tip()
 
-                logs_file.close()
+        if tip is None:
+            last_block = self.blockchain_db.get_last_block()
 
-        return {'success': transaction.get("plot_num", None)}
+            if last_block is not None:
+                tip = self.blockchain_db.set_tip(
+                    last_block, SecurityController().hash_block(last_block))
 
-    def extract_chain(self):
+        return tip
+
+    def extract_chain(self, since=0):
         '''
         Fetches the blockchain cursor object, unpacks it and returns it.
         To return the chain, status of pending transactions should be
-        false else advise requesting node of the status -> list
+        false else advise requesting node of the status. If param[since] is
+        set, only the blocks after the block at that index are returned
+        -> list
         '''
 
-        if BlockController.pending_transactions:
+        result_cursor = self.chain_cursor(since)
+
+        if result_cursor is None:
             return None
 
-        result_cursor = self.blockchain_db.get_chain()
         chain = [document for document in result_cursor]
 
         return chain
 
+    def get_blocks_page(self, start=1, limit=20, date_from=None,
+                        date_to=None):
+        '''
+        Returns a page of up to param[limit] blocks from the block at
+        param[start] and the cursor of the next page -> (list, int or None)
+            1. One extra block is fetched to tell if there is a next page.
+            2. The cursor is the index of the page's last block, the next
+            page is fetched with start=cursor+1.
+        '''
+
+        blocks = self.blockchain_db.get_blocks_range(
+            start, limit + 1, date_from, date_to)
+
+        if len(blocks) > limit:
+            blocks = blocks[:limit]
+            return blocks, blocks[-1]['index']
+
+        return blocks, None
+
+    def chain_cursor(self, since=0, batch_size=0):
+        '''Returns a cursor over the blockchain, or the blocks after the block
+        at param[since], for streaming it out. None if there are pending
+        transactions -> cursor object'''
+
+        if BlockController.pending_transactions:
+            return None
+
+        if since:
+            return self.blockchain_db.get_blocks_since(since, batch_size)
+
+        return self.blockchain_db.get_chain(batch_size=batch_size)
+
     def sync(self, update_chain=False):
         '''
         1. If param[update_chain] is False (default), then only the node
@@ -232,17 +626,21 @@ class BlockController:
 
         if update_chain:
             endpoint = 'blocks'
-            max_len = self.blockchain_db.get_chain(True)
+            tip_block = self.blockchain_db.get_last_block()
+            max_len = tip_block['index'] if tip_block else 0
+            tip_hash = self.blockchain_db.get_block_hash(max_len) \
+                if tip_block else None
 
             response_data = self.net_controller.request_data(
-                nodes_list, endpoint, max_len)
+                nodes_list, endpoint, max_len, tip_block, tip_hash)
 
             if len(response_data['error_nodes']) > 0:
                 return {'sync_error': response_data['error_nodes']}
 
             else:
                 if len(response_data['payload']) > 0:
-                    self.replace_blockchain(response_data['payload'])
+                    self.replace_blockchain(response_data['payload'],
+                                            response_data['since'])
 
     def validate_transaction(self, validation_data):
         '''Ensure no duplicate transaction before block forging -> dict'''
@@ -254,24 +652,317 @@ class BlockController:
             if self.blockchain_db.block_exists(validation_data['buyer_id']):
                 return 'Invalid Transaction. Re-check input data'
 
-    def replace_blockchain(self, chain):
-        '''Replaces the blockchain with an valid updated one from
+    def split_batch(self, records):
+        '''
+        Splits a batch of queued transactions into the transactions to
+        forge into a block now, those to forge into a later block and the
+        invalid ones, which are dropped -> (list, list, list)
+            1. Transactions are validated when queued, but one forged since
+            may duplicate them. A transaction is dropped if
+            validate_transaction rejects it or an earlier transaction of the
+            batch has the same buyer.
+            2. A transaction on the same plot as an earlier transaction of
+            the batch is forged later, so a block records one sale per plot.
+        '''
+
+        forge_now, forge_later, dropped = [], [], []
+        buyers, plots = set(), set()
+
+        for record in records:
+            buyer_id = record.get('buyer_id')
+
+            if buyer_id in buyers or self.validate_transaction(record):
+                logger.warning('Dropped duplicate transaction: buyer %s, '
+                               'plot %s', buyer_id, record.get('plot_num'))
+                dropped.append(record)
+                continue
+
+            if buyer_id:
+                buyers.add(buyer_id)
+
+            if record.get('plot_num') in plots:
+                forge_later.append(record)
+            else:
+                plots.add(record.get('plot_num'))
+                forge_now.append(record)
+
+        return forge_now, forge_later, dropped
+
+    @tracing.traced('replace_blockchain')
+    def replace_blockchain(self, chain, since=0):
+        '''
+        Replaces the blockchain with an valid updated one from
         another peer hub -> None
+            1. If param[since] is set, param[chain] holds only the blocks
+            that follow our block at that index.
+            2. Otherwise our own blocks are kept up to the last block the
+            two chains share (the fork).
+            3. Only the blocks after the fork are replaced, in a single bulk
+            write (see BlockModel.replace_blocks).
+        '''
+
+        security = SecurityController()
+
+        if since:
+            fork_index, new_blocks = since, chain
+        else:
+            position = security.verified_position(chain)
+            fork_index = position + 1 if position \
+                else self.find_fork_index(chain)
+            new_blocks = chain[fork_index:]
+
+        if not new_blocks:
+            return
+
+        tip = self.chain_tip()
+        last_index = tip['index'] if tip else 0
+
+        # Our blocks after the fork, that will be replaced
+        removed_blocks, fork_block = [], None
+
+        if fork_index < last_index:
+            removed_blocks = list(self.blockchain_db.get_blocks_since(
+                fork_index))
+
+        if fork_index:
+            fork_block = tip if fork_index == last_index \
+                else self.blockchain_db.get_block(fork_index)
+
+        block_hash = security.hash_block(new_blocks[-1])
+        self.blockchain_db.replace_blocks(
+            fork_block, new_blocks[0]['previous_hash'], new_blocks,
+            block_hash)
+
+        security.discard_checkpoints(fork_index)
+        security.checkpoint_block(new_blocks[-1], block_hash)
+
+        # Update the Redis cache with the new blocks, first restoring the
+        # records of any replaced blocks
+        if removed_blocks:
+            self.cache_controller.rewind_blockchain_cache(
+                fork_index, removed_blocks)
+        else:
+            self.cache_controller.update_blockchain_cache()
+
+        self.update_plot_history(fork_index)
+
+    def find_fork_index(self, chain):
+        '''
+        Returns the index of the last block that param[chain], a validated
+        chain, shares with our chain -> int
+            1. Both chains are hash linked, so once a block differs all the
+            blocks after it differ too.
+            2. The fork is therefore found with a binary search, costing
+            O(log n) reads of our blocks' stored hashes, compared with the
+            previous_hash of the chain's next block.
+        '''
+
+        tip = self.chain_tip()
+        low, high = 0, min(len(chain), tip['index'] if tip else 0)
+
+        while low < high:
+            middle = (low + high + 1) // 2
+            stored_hash = None
+
+            if middle < len(chain):
+                stored_hash = self.blockchain_db.get_block_hash(middle)
+
+            if stored_hash is not None:
+                shared = stored_hash == chain[middle]['previous_hash']
+            else:
+                shared = self.blockchain_db.get_block(middle) == \
+                    chain[middle - 1]
+
+            if shared:
+                low = middle
+            else:
+                high = middle - 1
+
+        return low
+
+    def append_block(self, block):
+        '''
+        Appends a block forged by another peer hub to our blockchain, if it
+        follows our last block: consecutive index, previous_hash matching
+        our last block's hash, a valid proof and merkle root -> boolean
         '''
 
-        self.blockchain_db.delete_chain()
+        security = SecurityController()
+        tip = self.chain_tip()
+
+        if tip is None or block.get('index') != tip['index'] + 1 or \
+                block.get('previous_hash') != tip['hash'] or \
+                not security.validate_work(
+                    tip, block, self.blockchain_db.get_block) or \
+                not security.validate_merkle_root(block):
+            return False
+
+        block_hash = security.hash_block(block)
+
+        try:
+            self.blockchain_db.persist_new_block(block, block_hash)
+        except DuplicateKeyError:
+            return False
+
+        security.checkpoint_block(block, block_hash)
+        self.cache_controller.update_blockchain_cache()
+        self.update_plot_history()
+
+        return True
 
-        for block in chain:
-            self.blockchain_db.persist_new_block(block)
+    def shares_block(self, index, block_hash):
+        '''
+        Checks whether our block at param[index] hashes to param[block_hash]
+        -> boolean or None if we have no block at that index
+        '''
+
+        tip = self.chain_tip()
+
+        if tip is not None and tip['index'] == index:
+            return tip['hash'] == block_hash
 
-        # Update the Redis cache
-        blockchain = self.extract_chain()
-        self.cache_controller.update_blockchain_cache(blockchain[1:])
+        stored_hash = self.blockchain_db.get_block_hash(index)
+
+        if stored_hash is not None:
+            return stored_hash == block_hash
+
+        block = self.blockchain_db.get_block(index)
+
+        if block is not None:
+            return SecurityController().hash_block(block) == block_hash
+
+    def update_plot_history(self, fork_index=None):
+        '''
+        Adds the blocks since the last block in the plot history index to
+        it -> None
+            1. If param[fork_index] is set, the entries of the replaced
+            blocks after it are first removed.
+            2. Blocks are read and indexed in batches of STREAM_BATCH_SIZE.
+        '''
+
+        history_tip = self.history_db.get_history_tip()
+
+        if fork_index is not None and fork_index < history_tip:
+            self.history_db.rewind(fork_index)
+            history_tip = fork_index
+
+        entries, tip_index = [], None
+
+        for block in self.blockchain_db.get_blocks_since(
+                history_tip, stream_batch_size):
+            plots = {transaction['plot_num'] for transaction in
+                     block_transactions(block) if 'plot_num' in transaction}
+            entries.extend({'plot_num': plot_num, 'index': block['index']}
+                           for plot_num in plots)
+            tip_index = block['index']
+
+            if len(entries) >= stream_batch_size:
+                self.history_db.add_entries(entries, tip_index)
+                entries = []
+
+        if tip_index is not None:
+            self.history_db.add_entries(entries, tip_index)
+
+    def plot_history(self, plot_num):
+        '''Returns the transactions on param[plot_num] in chain order, with
+        the index and date of their blocks, from the plot history index
+        -> list'''
+
+        history = []
+        indices = self.history_db.get_plot_indices(plot_num)
+
+        for block in self.blockchain_db.get_blocks(indices):
+            history.extend({
+                'index': block['index'],
+                'date': block['date'],
+                'transaction': transaction
+            } for transaction in block_transactions(block)
+                if transaction.get('plot_num') == plot_num)
+
+        return history
+
+    def inclusion_proof(self, plot_num):
+        '''
+        Returns the proof that the last transaction on param[plot_num] is in
+        our chain, or None if there is none -> dict
+            1. 'transaction' is the transaction and 'block' the header of the
+            block holding it (see SecurityController.block_header).
+            2. 'merkle_path' proves the transaction is under the header's
+            merkle root (see SecurityController.verify_merkle_path).
+            3. 'headers' are the headers of the blocks after it, up to our
+            tip, each linked to the previous one by its previous_hash.
+            4. Blocks forged before merkle roots are sent whole, with no
+            merkle path, as their hash covers their transactions.
+        '''
+
+        tip = self.chain_tip()
+
+        if tip is None:
+            return None
+
+        block = self.blockchain_db.get_last_plot_block(plot_num, tip['index'])
+
+        if block is None:
+            return None
+
+        security = SecurityController()
+        transactions = block_transactions(block)
+        position = max(position for position, transaction in
+                       enumerate(transactions)
+                       if transaction.get('plot_num') == plot_num)
+
+        def header(block):
+            if 'merkle_root' in block:
+                return security.block_header(block)
+            return block
+
+        return {
+            'transaction': transactions[position],
+            'block': header(block),
+            'merkle_path': security.merkle_path(transactions, position)
+            if 'merkle_root' in block else None,
+            'headers': [header(next_block) for next_block in
+                        self.blockchain_db.get_blocks_since(block['index'])]
+        }
+
+    def create_indexes(self):
+        '''Creates the blockchain's db indexes, on bootstrap. Duplicate
+        blocks at an index prevent its unique index, so are removed first
+        -> None'''
+
+        try:
+            self.blockchain_db.create_indexes()
+        except DuplicateKeyError:
+            removed = self.blockchain_db.remove_duplicate_blocks(
+                self.net_controller.security.hash_block)
+            logger.warning('Removed %s duplicate blocks to index the chain',
+                           removed)
+            self.blockchain_db.create_indexes()
+
+        self.history_db.create_indexes()
+
+    def index_block_hashes(self):
+        '''Stores the hashes of blocks saved before block hashes were, on
+        bootstrap -> None'''
+
+        security, block_hashes = SecurityController(), {}
+
+        for block in self.blockchain_db.get_unhashed_blocks():
+            block_hashes[block['index']] = security.hash_block(block)
+
+            if len(block_hashes) == stream_batch_size:
+                self.blockchain_db.set_block_hashes(block_hashes)
+                block_hashes = {}
+
+        self.blockchain_db.set_block_hashes(block_hashes)
 
 
 class NodeController:
     '''Manages node registration and access to the node registry'''
 
+    # Peer nodes known to be registered, per process
+    known_nodes = set()
+
     def __init__(self):
         '''Initializes this node with a uuid and captures its host IP'''
 
@@ -280,22 +971,32 @@ class NodeController:
         self.node_host = f'{public_ip}:{port}'
         # {'198.162.1.2:5000'}
 
+    def register_init_node(self):
+        '''Registers the network's init node as a peer, if set -> None'''
+
         if init_node:
             self.register_node(init_node)
 
     def register_node(self, node_url):
         '''
         Adds a new peer node address ('198.162.1.2:5000'), ensuring it is not
-        already registered and that we don't register this node -> None
+        already registered and that we don't register this node -> None.
+        Known peers are skipped without querying the registry.
         '''
 
-        if not self.nodes_db.get_node(node_url) and node_url != self.node_host:
+        if node_url in NodeController.known_nodes or \
+                node_url == self.node_host:
+            return
+
+        if not self.nodes_db.get_node(node_url):
             node = {
                 'node_url': node_url
             }
 
             self.nodes_db.persist_new_node(node)
 
+        NodeController.known_nodes.add(node_url)
+
     def extract_nodes(self):
         '''
         Fetches the node registry cursor object, unpacks it and returns it
@@ -310,32 +1011,149 @@ class NodeController:
 class NetworkController:
     '''Manages peer node interation in the blockchain network'''
 
-    def __init__(self):
+    # Keep-alive sessions per peer node and the pool of threads that
+    # contacts all peers concurrently, per process
+    _sessions, _executor, _executor_pid = {}, None, None
+    _sessions_lock = Lock()
+
+    # The body type and content encoding each peer accepts for posted
+    # blocks {node_url: (mimetype, encoding)}, as advertised in its
+    # blockchain responses. Other peers are sent plain JSON.
+    peer_formats = {}
+
+    def __init__(self, security=None):
         '''Initializes dependant class properties'''
 
-        self.security = SecurityController()
+        self.security = security or SecurityController()
         self.auth_header = {
-            'URL': NodeController().node_host,
+            'URL': f'{public_ip}:{port}',
             'API_KEY': self.security.blockchain_key()
         }
+        self.timeout = (peer_connect_timeout, peer_read_timeout)
+
+    def get_session(self, node_url):
+        '''Returns the keep-alive session for a peer node, reusing its
+        connections across requests -> requests.Session'''
+
+        with NetworkController._sessions_lock:
+            session = NetworkController._sessions.get(node_url)
+
+            if session is None:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(
+                    pool_connections=1, pool_maxsize=peer_pool_size))
+                NetworkController._sessions[node_url] = session
+
+        return session
+
+    def contact_nodes(self, node_url_list, node_request):
+        '''
+        Calls param[node_request](node_url) for all peer nodes concurrently
+        and returns their results in node order -> list
+            1. Results are (node_url, result, error) tuples.
+            2. Nodes that have not responded by the peer deadline get a
+            TimeoutError, so the wait is bound by the slowest responsive
+            node rather than the sum of all of them.
+        '''
+
+        with NetworkController._sessions_lock:
+            if NetworkController._executor is None or \
+                    NetworkController._executor_pid != getpid():
+                NetworkController._executor = ThreadPoolExecutor(
+                    max_workers=peer_pool_size)
+                NetworkController._executor_pid = getpid()
+
+            executor = NetworkController._executor
+
+        requests_sent = [(node_url, executor.submit(node_request, node_url))
+                         for node_url in node_url_list]
+        wait([sent for _, sent in requests_sent], timeout=peer_deadline)
+
+        results = []
+
+        for node_url, sent in requests_sent:
+            if not sent.done():
+                sent.cancel()
+                results.append((node_url, None, TimeoutError(node_url)))
+
+            elif sent.exception() is not None:
+                results.append((node_url, None, sent.exception()))
+
+            else:
+                results.append((node_url, sent.result(), None))
 
-    def request_data(self, node_url_list, endpoint, max_data_length):
+        return results
+
+    @tracing.traced('request_data')
+    def request_data(self, node_url_list, endpoint, max_data_length,
+                     tip_block=None, tip_hash=None):
 
         '''
         Sends HTTP GET requests to peer nodes for either their node
         registry or blockchain data and returns the payload and a dict of
         nodes that did not respond with a 200, if any -> dict
+            1. With param[tip_block] (our last block, hashing to
+            param[tip_hash] if stored), peers are only asked for the blocks
+            after it. A peer whose chain diverged from ours is asked for its
+            entire chain instead.
+            2. The returned 'since' is the index of the block the payload
+            follows, 0 for an entire chain.
+            3. All peers are requested concurrently, within the peer
+            deadline. A diverged peer's entire chain is requested within
+            what is left of it.
         '''
 
-        error_nodes, payload, mlen = [], [], max_data_length
+        error_nodes, payload, mlen, payload_since = [], [], max_data_length, 0
+        url_params, deadline = None, monotonic() + peer_deadline
+        tracing.current_span().set(endpoint=endpoint,
+                                   peers=len(node_url_list))
 
-        for node_url in node_url_list:
-            try:
-                response = requests.get(
-                    f'http://{node_url}/backend/v1/{endpoint}',
-                    headers=self.auth_header)
+        if endpoint == 'blocks' and tip_block:
+            url_params = {
+                'since': tip_block['index'],
+                'tip': tip_hash or self.security.hash_block(tip_block)
+            }
 
-            except Exception:
+        headers = dict(self.auth_header, Accept=wire.accept_header())
+
+        def node_request(node_url):
+            url = f'http://{node_url}/backend/v1/{endpoint}'
+            session = self.get_session(node_url)
+
+            with metrics.PEER_REQUESTS.time(
+                    peer=node_url, operation='request_data',
+                    endpoint=endpoint):
+                response = session.get(url, headers=headers,
+                                       params=url_params, timeout=self.timeout)
+                data = wire.load_response(response) \
+                    if response.status_code == 200 else None
+
+                if data and data.get('diverged_at'):
+                    remaining = deadline - monotonic()
+
+                    if remaining <= 0:
+                        raise TimeoutError(node_url)
+
+                    response = session.get(
+                        url, headers=headers,
+                        timeout=(min(peer_connect_timeout, remaining),
+                                 min(peer_read_timeout, remaining)))
+                    data = wire.load_response(response) \
+                        if response.status_code == 200 else None
+
+            self.record_peer_format(node_url, response)
+
+            return response, data
+
+        for node_url, result, error in self.contact_nodes(
+                node_url_list, node_request):
+
+            if error is not None or result[0].status_code != 200:
+                metrics.PEER_ERRORS.inc(peer=node_url,
+                                        operation='request_data',
+                                        endpoint=endpoint)
+
+            if error is not None:
                 error_nodes.append(
                     {
                         'message': f'Failed to connect to: {node_url}'
@@ -344,15 +1162,27 @@ class NetworkController:
 
                 continue
 
+            response, data = result
+
             if response.status_code == 200:
-                curr_len = len(response.json()['payload'])
-                curr_data = response.json()['payload']
+                curr_data = data['payload']
+                curr_len = len(curr_data)
 
                 if endpoint == 'blocks':
+                    chain, since = curr_data, data.get('since', 0)
+
+                    # Peers ignoring our tip send their entire chain
+                    if url_params and since == url_params['since']:
+                        chain = [tip_block] + curr_data
+                        curr_len += since
+                    else:
+                        since = 0
+
                     if curr_len > mlen and \
-                            self.security.validate_chain(curr_data):
+                            self.security.validate_chain(chain):
                         mlen = curr_len
                         payload = curr_data
+                        payload_since = since
 
                 else:
                     if curr_len > mlen:
@@ -368,72 +1198,279 @@ class NetworkController:
                     }
                 )
 
-        return {'payload': payload, 'error_nodes': error_nodes}
+        return {'payload': payload, 'since': payload_since,
+                'error_nodes': error_nodes}
 
-    def send_data(self, node_url_list, blockchain):
-        '''Sends POST requests to peer hubs to update their blockchains'''
+    @tracing.traced('send_data')
+    def send_data(self, node_url_list, blockchain, endpoint='blocks'):
+        '''Sends POST requests to peer hubs to update their blockchains,
+        concurrently. With param[endpoint] 'blocks/new', param[blockchain]
+        is a single new block for peers to append'''
 
-        error_nodes = []
-        self.auth_header['Content-type'] = 'application/json'
+        error_nodes, bodies = [], {}
+        tracing.current_span().set(endpoint=endpoint,
+                                   peers=len(node_url_list))
 
-        for node_url in node_url_list:
-            try:
-                res = requests.post(
-                    f'http://{node_url}/backend/v1/blocks',
-                    headers=self.auth_header,
-                    data=json.dumps(blockchain))
+        def node_request(node_url):
+            mimetype, encoding = NetworkController.peer_formats.get(
+                node_url, (wire.JSON, None))
 
-            except Exception:
+            # Peers accepting the same format share an encoded body
+            if (mimetype, encoding) not in bodies:
+                bodies[mimetype, encoding] = self.encode_body(
+                    blockchain, mimetype, encoding)
+
+            body, body_encoding = bodies[mimetype, encoding]
+            headers = dict(self.auth_header, **{'Content-Type': mimetype})
+
+            if body_encoding:
+                headers['Content-Encoding'] = body_encoding
+
+            with metrics.PEER_REQUESTS.time(
+                    peer=node_url, operation='send_data', endpoint=endpoint):
+                res = self.get_session(node_url).post(
+                    f'http://{node_url}/backend/v1/{endpoint}',
+                    headers=headers, data=body, timeout=self.timeout)
+
+            if res.status_code not in (200, 201):
+                return f"{res.status_code} | {res.json()['message']}"
+
+        for node_url, result, error in self.contact_nodes(
+                node_url_list, node_request):
+
+            if error is not None or result:
+                metrics.PEER_ERRORS.inc(peer=node_url, operation='send_data',
+                                        endpoint=endpoint)
+
+            if error is not None:
                 error_nodes.append(
                     {
                         'message': f'Failed to connect to: {node_url}'
                     }
                 )
 
-                continue
-
-            if res.status_code != 200:
-                error_nodes.append(
-                    {'message': f"{res.status_code} | {res.json()['message']}"}
-                )
+            elif result:
+                error_nodes.append({'message': result})
 
         return {'update_error_nodes': error_nodes}
 
+    def record_peer_format(self, node_url, response):
+        '''Records the best body type and content encoding a peer accepts
+        for posted blocks, from its response's Accept-Post and
+        Accept-Encoding headers -> None'''
+
+        accept_post = response.headers.get('Accept-Post')
+
+        if accept_post is None:
+            return
+
+        types = [mimetype.strip() for mimetype in accept_post.split(',')]
+        encodings = [encoding.strip() for encoding in
+                     response.headers.get('Accept-Encoding', '').split(',')]
+
+        mimetype = next((mimetype for mimetype in wire.accepted_types()
+                         if mimetype in types), wire.JSON)
+        encoding = next((encoding for encoding in wire.ENCODINGS
+                         if encoding in encodings), None)
+
+        NetworkController.peer_formats[node_url] = (mimetype, encoding)
+
+    def encode_body(self, data, mimetype, encoding=None):
+        '''Encodes param[data] as a param[mimetype] request body, compressed
+        with param[encoding] if set and the body is worth compressing
+        -> (bytes, str or None) the body and its content encoding'''
+
+        body = wire.dumps(data, mimetype)
+
+        if not encoding or not compression_level or \
+                len(body) < wire.MIN_COMPRESSED_SIZE:
+            return body, None
+
+        compressor = wire.compressor(encoding, compression_level)
+
+        return compressor.compress(body) + compressor.flush(), encoding
+
 
 class SecurityController:
     '''Manages creation of node security features and authorization'''
 
-    def validate_proof(self, last_proof, proof):
+    # The hashed blockchain key, computed once
+    BLOCKCHAIN_ID = '87a56999-9a36-4359-a8c2-8217260f5a85'
+    _blockchain_key = hashlib.sha256(
+        f'{secret_key}-{BLOCKCHAIN_ID}'.encode()).hexdigest().encode()
+
+    # Recently verified blocks of our chain {index: hash}
+    verified_blocks = OrderedDict()
+    max_verified_blocks = 64
+    _verified_lock = Lock()
+
+    # Proof of work difficulty bounds, in leading zero bits. Blocks forged
+    # without a difficulty needed 4 leading zero hex digits (16 bits).
+    LEGACY_DIFFICULTY = 16
+    MIN_DIFFICULTY, MAX_DIFFICULTY = 1, 64
+
+    # The lowest difficulty blocks are accepted (and retargeted) at
+    min_difficulty = max(pow_min_difficulty, MIN_DIFFICULTY)
+
+    # The kernel searching and verifying proofs, see pow_kernels
+    pow_kernel = pow_kernels.get_kernel(pow_kernel)
+
+    # The most a retarget moves the difficulty (bits) and how far ahead of
+    # our clock (s) a block's timestamp may be
+    MAX_RETARGET_STEP = 2
+    MAX_FUTURE_TIME = 300
+
+    def validate_proof(self, last_proof, proof,
+                       difficulty=LEGACY_DIFFICULTY):
         '''
         Validates that the hash of two consequtive proofs concat(last_proof,
         current_proof), satisfies the proof_of_work algorithm, since the
         current_block's proof is computed using the previous_block's proof
         -> boolean
+            1. The hash must start with param[difficulty] zero bits, that is
+            be below the difficulty's target when read as a big-endian
+            number, so the raw digest bytes are compared.
         '''
 
-        guess_hash = hashlib.sha256(
-            f'{last_proof}{proof}'.encode()).hexdigest()
-        return guess_hash[:4] == '0000'
+        return self.pow_kernel.verify(last_proof, proof, difficulty)
 
-    def proof_of_work(self, last_proof, current_proof=None):
+    def proof_of_work(self, last_proof, current_proof=None,
+                      difficulty=LEGACY_DIFFICULTY):
         '''
         Returns a valid proof for the new block to be forged. Computation
         algorithm: Find a number 'proof' (for the current block being forged)
-        such that concat(last_proof, proof) contains at least 4 leading zeros
-        -> int
+        such that the hash of concat(last_proof, proof) starts with
+        param[difficulty] zero bits -> int
+            1. The smallest such proof is searched by the POW_KERNEL kernel,
+            in-process or across the mining pool's workers.
         '''
 
-        proof = 0
-        while self.validate_proof(last_proof, proof) is False:
-            proof += 1
+        with metrics.POW_SEARCHES.time():
+            proof = None
+
+            if pow_workers > 1:
+                proof = MiningController().proof_of_work(
+                    last_proof, difficulty)
+
+            if proof is None:
+                proof = self.pow_kernel.search(last_proof, difficulty)
+
+        # The proofs below the smallest valid one were all checked
+        metrics.POW_ITERATIONS.inc(proof + 1)
+
         return proof
 
+    def block_difficulty(self, block):
+        '''Returns the difficulty a block was forged at -> int'''
+
+        return block.get('difficulty') or self.LEGACY_DIFFICULTY
+
+    def next_difficulty(self, previous_block, block_at):
+        '''
+        Returns the difficulty of the block after param[previous_block]
+        (a block or chain tip record) -> int
+            1. Without retargeting, it is the POW_DIFFICULTY setting.
+            2. Blocks after POW_RETARGET_HEIGHT are retargeted: their
+            difficulty is the previous block's, except every
+            POW_RETARGET_INTERVAL blocks. It is then moved by log2(target /
+            actual time) of the last interval's blocks, by at most
+            MAX_RETARGET_STEP bits, so each bit halves or doubles the work.
+            3. param[block_at](index) returns the block at an index, for the
+            first block of the interval.
+            4. Retargeting starts from POW_DIFFICULTY, as blocks without a
+            difficulty or timestamp are not retargeted from.
+            5. It is never below POW_MIN_DIFFICULTY.
+        '''
+
+        if previous_block is None or \
+                not self.retargeted(previous_block['index'] + 1):
+            return max(pow_difficulty, self.min_difficulty)
+
+        difficulty = max(previous_block.get('difficulty') or pow_difficulty,
+                         self.min_difficulty)
+        index = previous_block['index']
+
+        if index % pow_retarget_interval or index <= pow_retarget_interval:
+            return difficulty
+
+        first_block = block_at(index - pow_retarget_interval)
+
+        if not first_block or first_block.get('timestamp') is None or \
+                previous_block.get('timestamp') is None:
+            return difficulty
+
+        elapsed = max(previous_block['timestamp'] - first_block['timestamp'],
+                      0.001)
+        step = round(math.log2(
+            pow_retarget_interval * pow_target_block_time / elapsed))
+        step = max(-self.MAX_RETARGET_STEP, min(self.MAX_RETARGET_STEP, step))
+
+        return max(self.min_difficulty,
+                   min(self.MAX_DIFFICULTY, difficulty + step))
+
+    def retargeted(self, index):
+        '''Checks if the difficulty of the block at param[index] is set by
+        retargeting, which applies after POW_RETARGET_HEIGHT -> boolean'''
+
+        return bool(pow_retarget_interval) and index > pow_retarget_height
+
+    def validate_work(self, previous_block, block, block_at):
+        '''
+        Validates param[block]'s proof of work, following param[previous_block]
+        (a block or chain tip record) -> boolean
+        '''
+
+        work = self.block_work(previous_block, block, block_at)
+
+        return work is not None and self.validate_proof(*work)
+
+    def block_work(self, previous_block, block, block_at):
+        '''
+        Returns the (last_proof, proof, difficulty) of param[block]'s proof
+        of work, following param[previous_block], or None if its difficulty
+        or timestamp are invalid -> tuple or None
+            1. A block's proof must meet the difficulty it was forged at,
+            which must be at least POW_MIN_DIFFICULTY. Hubs forge at their
+            POW_DIFFICULTY, so changing it does not invalidate any chain.
+            2. Retargeted blocks (see retargeted) must have the difficulty
+            retargeting dictates (see next_difficulty).
+            3. Blocks following a block with a difficulty must have one
+            too, with a timestamp no earlier than the previous block's and
+            not ahead of our clock by more than MAX_FUTURE_TIME.
+            4. Legacy blocks, without a difficulty, are checked at 16 bits.
+        '''
+
+        if 'difficulty' not in block:
+            if previous_block.get('difficulty') is not None:
+                return None
+
+            return (previous_block['proof'], block.get('proof'),
+                    self.LEGACY_DIFFICULTY)
+
+        timestamp = block.get('timestamp')
+        previous_timestamp = previous_block.get('timestamp') or 0
+
+        if not isinstance(timestamp, (int, float)) or \
+                timestamp < previous_timestamp or \
+                timestamp > time() + self.MAX_FUTURE_TIME:
+            return None
+
+        difficulty = block['difficulty']
+
+        if not isinstance(difficulty, int) or \
+                not self.min_difficulty <= difficulty <= self.MAX_DIFFICULTY:
+            return None
+
+        if self.retargeted(block['index']) and \
+                difficulty != self.next_difficulty(previous_block, block_at):
+            return None
+
+        return previous_block['proof'], block.get('proof'), difficulty
+
     def blockchain_key(self):
         '''Returns the hashed blockchain key -> str'''
 
-        BLOCKCHAIN_ID = '87a56999-9a36-4359-a8c2-8217260f5a85'
-        key = f'{secret_key}-{BLOCKCHAIN_ID}'
-        return hashlib.sha256(key.encode()).hexdigest()
+        return SecurityController._blockchain_key.decode()
 
     def hash_block(self, block):
         '''
@@ -443,38 +1480,486 @@ class SecurityController:
             3. hexdigest() return block hash in hexadecimal digits
             4. The block dictionary should be ordered or the hashes will be
             inconsistent.
+            5. A block's stored 'hash' is not part of its hash.
+            6. Blocks with a merkle_root are hashed by their header (see
+            block_header), their transactions being committed to by it.
         '''
 
+        if 'merkle_root' in block:
+            block = self.block_header(block)
+
+        elif 'hash' in block:
+            block = {key: value for key, value in block.items()
+                     if key != 'hash'}
+
         block_uni = json.dumps(block, sort_keys=True).encode()
         return hashlib.sha256(block_uni).hexdigest()
 
+    def block_header(self, block):
+        '''Returns a block without its transactions and stored hash -> dict'''
+
+        return {key: value for key, value in block.items()
+                if key not in ('transaction', 'transactions', 'hash')}
+
+    def merkle_leaf(self, transaction):
+        '''Returns the merkle tree leaf hash of a transaction -> str'''
+
+        transaction_uni = json.dumps(transaction, sort_keys=True).encode()
+        return hashlib.sha256(b'\x00' + transaction_uni).hexdigest()
+
+    def merkle_node(self, left, right):
+        '''Returns the merkle tree hash of two child hashes -> str'''
+
+        return hashlib.sha256(f'\x01{left}{right}'.encode()).hexdigest()
+
+    def merkle_levels(self, transactions):
+        '''
+        Returns the levels of the merkle tree over param[transactions], from
+        the leaves to the root -> list
+            1. Leaves and inner nodes are hashed with distinct prefixes, so
+            an inner node can not pass for a transaction.
+            2. A level with an odd number of hashes pairs its last hash with
+            itself.
+        '''
+
+        level = [self.merkle_leaf(transaction) for transaction in transactions]
+        levels = [level]
+
+        while len(level) > 1:
+            if len(level) % 2:
+                level = level + level[-1:]
+
+            level = [self.merkle_node(level[position], level[position + 1])
+                     for position in range(0, len(level), 2)]
+            levels.append(level)
+
+        return levels
+
+    def merkle_mutated(self, levels):
+        '''Checks if the merkle tree of param[levels] pairs two equal
+        hashes. An odd level pairs its last hash with itself, so appending a
+        copy of the last transaction (or subtree) keeps the merkle root
+        -> boolean'''
+
+        return any(level[position] == level[position + 1]
+                   for level in levels[:-1]
+                   for position in range(0, len(level) - 1, 2))
+
+    def merkle_root(self, transactions):
+        '''Returns the merkle root of a block's transactions -> str'''
+
+        return self.merkle_levels(transactions)[-1][0]
+
+    def merkle_path(self, transactions, position):
+        '''Returns the inclusion path of the transaction at param[position]
+        in param[transactions], as [{hash, side}] sibling hashes from the
+        leaf up -> list'''
+
+        path = []
+
+        for level in self.merkle_levels(transactions)[:-1]:
+            sibling = position ^ 1
+            sibling_hash = level[sibling] if sibling < len(level) \
+                else level[position]
+
+            path.append({'hash': sibling_hash,
+                         'side': 'left' if sibling < position else 'right'})
+            position //= 2
+
+        return path
+
+    def verify_merkle_path(self, transaction, path, merkle_root):
+        '''Checks that param[path] proves the inclusion of param[transaction]
+        under param[merkle_root] -> boolean'''
+
+        node_hash = self.merkle_leaf(transaction)
+
+        for step in path:
+            if step['side'] == 'left':
+                node_hash = self.merkle_node(step['hash'], node_hash)
+            else:
+                node_hash = self.merkle_node(node_hash, step['hash'])
+
+        return node_hash == merkle_root
+
+    def validate_merkle_root(self, block):
+        '''Checks that a block's merkle_root, if any, commits to its
+        transactions, which must not include duplicates that leave the root
+        unchanged (see merkle_mutated) -> boolean'''
+
+        if 'merkle_root' not in block:
+            return True
+
+        if 'transaction' not in block and 'transactions' not in block:
+            return False
+
+        levels = self.merkle_levels(block_transactions(block))
+
+        return block['merkle_root'] == levels[-1][0] and \
+            not self.merkle_mutated(levels)
+
     def authorize_node(self, header):
         '''
-        Authenticates and authorizes the requesting node to access our data
-        -> str
+        Authenticates and authorizes the requesting node to access our data,
+        comparing keys in constant time -> str
         '''
-        if header['Api-Key'] == self.blockchain_key() and \
-                header['Url'] != NodeController().node_host:
+        api_key = header['Api-Key'].encode('utf-8', 'surrogateescape')
+
+        if hmac.compare_digest(api_key, SecurityController._blockchain_key) \
+                and header['Url'] != f'{public_ip}:{port}':
             return header['Url']
 
+    def checkpoint_block(self, block, block_hash=None):
+        '''Records a verified block of our chain, so that chains sharing our
+        chain up to it are not re-validated -> None'''
+
+        with SecurityController._verified_lock:
+            verified = SecurityController.verified_blocks
+            verified[block['index']] = block_hash or self.hash_block(block)
+            verified.move_to_end(block['index'])
+
+            while len(verified) > SecurityController.max_verified_blocks:
+                verified.popitem(last=False)
+
+    def discard_checkpoints(self, index):
+        '''Forgets the verified blocks after param[index], once they are no
+        longer part of our chain -> None'''
+
+        with SecurityController._verified_lock:
+            verified = SecurityController.verified_blocks
+
+            for block_index in [i for i in verified if i > index]:
+                del verified[block_index]
+
+    def verified_position(self, chain):
+        '''
+        Returns the position of the last block in param[chain] that is also
+        a verified block of our chain, or 0 if there is none -> int
+            1. Recently verified blocks are tried first, each candidate
+            costing a single block hash. As other processes may have
+            reorganized our chain since, a candidate is only trusted if it
+            is still the stored block at its index.
+            2. Otherwise the last block whose next block links to one of our
+            stored block hashes is found with a binary search, then checked
+            with a single block hash.
+            3. The chain's blocks up to that position are not verified, so
+            only our own blocks may be kept up to it (see replace_blockchain).
+        '''
+
+        with SecurityController._verified_lock:
+            candidates = sorted(SecurityController.verified_blocks.items(),
+                                reverse=True)
+
+        blockchain_db = BlockModel()
+
+        for index, block_hash in candidates:
+            position = index - 1
+
+            if 0 < position < len(chain) and \
+                    chain[position].get('index') == index and \
+                    self.hash_block(chain[position]) == block_hash and \
+                    blockchain_db.get_block_hash(index) == block_hash:
+                return position
+
+        def stored_hash(position):
+            index = chain[position].get('index')
+            return blockchain_db.get_block_hash(index) \
+                if isinstance(index, int) else None
+
+        low, high = 0, len(chain) - 2
+
+        while low < high:
+            middle = (low + high + 1) // 2
+            linked_hash = stored_hash(middle)
+
+            if linked_hash is not None and \
+                    linked_hash == chain[middle + 1].get('previous_hash'):
+                low = middle
+            else:
+                high = middle - 1
+
+        if low and stored_hash(low) == self.hash_block(chain[low]):
+            return low
+
+        return 0
+
     def validate_chain(self, chain):
-        '''Checks a blockchain's validity -> boolean'''
+        '''Checks a blockchain's validity, only verifying the blocks after
+        the last block it shares with our chain. Block hashes only cover
+        the merkle roots of blocks that have one, so these are checked
+        against the blocks' transactions. The blocks' proofs are verified
+        last, in a single batch -> boolean'''
+
+        current_index = self.verified_position(chain)
+        previous_block = chain[current_index]
+        current_index += 1
+        blockchain_db, first_index = BlockModel(), chain[0].get('index')
+        proofs = []
+
+        def block_at(index):
+            # The chain's own blocks, or ours before it
+            position = index - first_index
 
-        previous_block = chain[0]
-        current_index = 1
+            if 0 <= position < len(chain):
+                return chain[position]
+
+            return blockchain_db.get_block(index)
+
+        if current_index == 1 and not self.validate_merkle_root(
+                previous_block):
+            return False
 
         while current_index < len(chain):
             current_block = chain[current_index]
 
+            if current_block['index'] != previous_block['index'] + 1:
+                return False
+
+            if not self.validate_merkle_root(current_block):
+                return False
+
             if current_block['previous_hash'] != \
                     self.hash_block(previous_block):
                 return False
 
-            if not self.validate_proof(previous_block['proof'],
-                                       current_block['proof']):
+            work = self.block_work(previous_block, current_block, block_at)
+
+            if work is None:
                 return False
 
+            proofs.append(work)
             previous_block = current_block
             current_index += 1
 
-        return True
+        return self.pow_kernel.verify_batch(proofs)
+
+
+class ControllerContainer:
+    '''
+    Holds the app's controllers, shared by all requests
+        1. Controllers are built on first use and then reused, so requests
+        do no setup work.
+        2. The node is bootstrapped once (db indexes created, init node
+        registered, chain seeded, block hashes stored, plot history indexed
+        and the cache warmed up) before the controllers are first handed
+        out.
+    '''
+
+    def __init__(self):
+        '''Initializes an empty container'''
+
+        self.bootstrapped = False
+        self._bootstrapping = False
+        self._controllers = {}
+        self._lock = RLock()
+
+    def get_controller(self, name, build):
+        '''Returns the named controller, building it with param[build] on
+        first use -> object'''
+
+        controller = self._controllers.get(name)
+
+        if controller is None:
+            with self._lock:
+                controller = self._controllers.get(name)
+
+                if controller is None:
+                    controller = build()
+                    self._controllers[name] = controller
+
+        return controller
+
+    @property
+    def security(self):
+        '''Returns the shared security controller -> SecurityController'''
+
+        return self.get_controller('security', SecurityController)
+
+    @property
+    def nodes(self):
+        '''Returns the shared node controller -> NodeController'''
+
+        return self.get_controller('nodes', NodeController)
+
+    @property
+    def cache(self):
+        '''Returns the shared cache controller -> CacheController'''
+
+        return self.get_controller('cache', CacheController)
+
+    @property
+    def network(self):
+        '''Returns the shared network controller -> NetworkController'''
+
+        return self.get_controller(
+            'network', lambda: NetworkController(self.security))
+
+    @property
+    def blocks(self):
+        '''Returns the shared block controller -> BlockController'''
+
+        return self.get_controller('blocks', lambda: BlockController(
+            self.cache, self.nodes, self.network))
+
+    def bootstrap(self, force=False):
+        '''
+        Bootstraps the node, only once unless param[force] is set
+        -> ControllerContainer
+            1. Requests arriving meanwhile wait for the bootstrap to
+            complete, so they are never handed a chain or cache that is not
+            ready.
+            2. The node is only marked bootstrapped once every step
+            succeeded, so a failed bootstrap (e.g. the db not being up yet)
+            is retried on next use.
+        '''
+
+        if self.bootstrapped and not force:
+            return self
+
+        with self._lock:
+            if self._bootstrapping or (self.bootstrapped and not force):
+                return self
+
+            self._bootstrapping = True
+
+            try:
+                self.blocks.create_indexes()
+                self.nodes.register_init_node()
+                self.blocks.seed_chain()
+                self.blocks.index_block_hashes()
+                self.blocks.update_plot_history()
+                self.cache.warm_start(self.blocks.chain_tip())
+                self.bootstrapped = True
+
+            except Exception:
+                self.bootstrapped = False
+                logger.exception('Bootstrap failed, retrying on next use')
+                raise
+
+            finally:
+                self._bootstrapping = False
+
+        return self
+
+
+def get_controllers(app=None):
+    '''Returns the bootstrapped controllers of param[app], defaults to the
+    current app -> ControllerContainer'''
+
+    app = app or current_app
+
+    return app.extensions['controllers'].bootstrap()
+
+
+# Shared [search_id, best_proof] of the current proof search, set in each
+# mining worker process by the pool initializer
+_mining_state = None
+
+
+def _init_miner(state):
+    '''Mining pool initializer, shares the proof search state -> None'''
+
+    global _mining_state
+    _mining_state = state
+
+
+def _mine_proofs(search_id, last_proof, start, end, difficulty):
+    '''
+    Mining pool task, returns the smallest valid proof in range [start, end)
+    or None. The task is abandoned once its search is over or a proof
+    smaller than param[start] has been found -> int or None
+    '''
+
+    kernel = SecurityController.pow_kernel
+
+    # The search state is checked between runs of 2048 proofs
+    for run_start in range(start, end, 2048):
+        curr_search, best_proof = _mining_state[:]
+
+        if curr_search != search_id or 0 <= best_proof < start:
+            return None
+
+        proof = kernel.search(last_proof, difficulty, run_start,
+                              min(run_start + 2048, end))
+
+        if proof is not None:
+            with _mining_state.get_lock():
+                if _mining_state[0] == search_id and \
+                        not 0 <= _mining_state[1] < proof:
+                    _mining_state[1] = proof
+
+            return proof
+
+
+class MiningController:
+    '''Manages the proof of work search across a pool of worker processes'''
+
+    _pool, _pool_pid, _state = None, None, None
+    _search_lock = Lock()
+
+    def __init__(self, workers=None, chunk_size=None):
+        '''Initializes the search's worker count and task size'''
+
+        self.workers = workers or pow_workers
+        self.chunk_size = chunk_size or pow_chunk_size
+
+    def get_pool(self):
+        '''Returns this process' mining pool, starting it on first use
+        -> ProcessPoolExecutor'''
+
+        if MiningController._pool is None or \
+                MiningController._pool_pid != getpid():
+            MiningController._state = Array('q', [0, -1])
+            MiningController._pool = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_miner,
+                initargs=(MiningController._state,))
+            MiningController._pool_pid = getpid()
+
+        return MiningController._pool
+
+    def proof_of_work(self, last_proof,
+                      difficulty=SecurityController.LEGACY_DIFFICULTY):
+        '''
+        Returns the smallest valid proof for param[last_proof] at
+        param[difficulty], or None if the pool broke down -> int or None
+            1. The proof space is split into consecutive tasks of chunk_size
+            proofs, with up to two tasks per worker in flight.
+            2. Task results are collected in submission order, so the first
+            proof found is the one the sequential search returns.
+            3. Once found, the search id is moved on to stop all workers.
+        '''
+
+        with MiningController._search_lock:
+            pool = self.get_pool()
+            state = MiningController._state
+
+            with state.get_lock():
+                state[0] += 1
+                state[1] = -1
+                search_id = state[0]
+
+            tasks, next_start = deque(), 0
+
+            try:
+                while True:
+                    while len(tasks) < self.workers * 2:
+                        tasks.append(pool.submit(
+                            _mine_proofs, search_id, last_proof,
+                            next_start, next_start + self.chunk_size,
+                            difficulty))
+                        next_start += self.chunk_size
+
+                    proof = tasks.popleft().result()
+
+                    if proof is not None:
+                        return proof
+
+            except BrokenProcessPool:
+                MiningController._pool = None
+
+            finally:
+                with state.get_lock():
+                    state[0] += 1
+
+                for task in tasks:
+                    task.cancel()
@@ -0,0 +1,216 @@
+'''
+This module records the backend's metrics and exposes them in the
+Prometheus text format:
+    1. Metrics are kept in memory per process, so each server worker
+        process is scraped (or aggregated) separately.
+    2. Recording a value takes a lock and a few additions, cheap enough for
+        the forge and sync paths. Labelled series are created on first use.
+    3. Histograms count observations in cumulative buckets (seconds by
+        default), from which latency quantiles are estimated.
+'''
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram bucket upper bounds, in seconds
+DURATION_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5,
+                    5, 10, 30)
+
+REGISTRY = []
+
+
+class Metric:
+    '''A named metric and its series of values per label values'''
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=()):
+        '''Initializes the metric and adds it to the registry'''
+
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.series = {}
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        '''Returns the series key of param[labels] -> tuple'''
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def label_text(self, key, extra=''):
+        '''Returns the {label="value"} text of a series -> str'''
+
+        pairs = [f'{label}="{escape(value)}"'
+                 for label, value in zip(self.labels, key)]
+
+        if extra:
+            pairs.append(extra)
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self):
+        '''Returns the text lines of all series -> list'''
+
+        with self._lock:
+            return [f'{self.name}{self.label_text(key)} {value}'
+                    for key, value in sorted(self.series.items())]
+
+    def render(self):
+        '''Returns the metric in the Prometheus text format -> str'''
+
+        return '\n'.join([f'# HELP {self.name} {self.documentation}',
+                          f'# TYPE {self.name} {self.kind}'] +
+                         self.samples())
+
+    def reset(self):
+        '''Clears all series -> None'''
+
+        with self._lock:
+            self.series.clear()
+
+
+class Counter(Metric):
+    '''A metric that only goes up'''
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''Adds param[amount] to the series of param[labels] -> None'''
+
+        key = self.key(labels)
+
+        with self._lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''A metric that is set to its current value'''
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        '''Sets the series of param[labels] to param[value] -> None'''
+
+        key = self.key(labels)
+
+        with self._lock:
+            self.series[key] = value
+
+
+class Histogram(Metric):
+    '''A metric counting observations in buckets'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DURATION_BUCKETS):
+        '''Initializes the histogram's bucket upper bounds'''
+
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        '''Counts param[value] in the series of param[labels] -> None'''
+
+        key = self.key(labels)
+        position = bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self.series.get(key)
+
+            if series is None:
+                # [count per bucket (the last one is +Inf), sum]
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0]
+
+            series[0][position] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        '''Observes the duration (s) of the with block -> context manager'''
+
+        start = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def samples(self):
+        '''Returns the cumulative bucket, sum and count lines of all series
+        -> list'''
+
+        lines = []
+
+        with self._lock:
+            series = sorted((key, list(counts), total)
+                            for key, (counts, total) in self.series.items())
+
+        for key, counts, total in series:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = self.label_text(key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+            lines.append(f'{self.name}_sum{self.label_text(key)} {total}')
+            lines.append(
+                f'{self.name}_count{self.label_text(key)} {cumulative}')
+
+        return lines
+
+
+def escape(value):
+    '''Escapes a label value for the text format -> str'''
+
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render():
+    '''Returns all metrics in the Prometheus text format -> str'''
+
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+# ------ BACKEND METRICS ------
+POW_SEARCHES = Histogram(
+    'pow_duration_seconds', 'Proof of work search time')
+POW_ITERATIONS = Counter(
+    'pow_iterations_total', 'Proofs checked by proof of work searches')
+
+FORGE_PHASES = Histogram(
+    'forge_phase_duration_seconds',
+    'Block forge time per phase (sync, pow, persist, cache, broadcast)',
+    labels=('phase',))
+FORGES = Counter(
+    'forge_blocks_total', 'Block forges by result (success, failure)',
+    labels=('result',))
+
+PEER_REQUESTS = Histogram(
+    'peer_request_duration_seconds',
+    'Peer node request time per peer and operation (request_data, '
+    'send_data)', labels=('peer', 'operation', 'endpoint'))
+PEER_ERRORS = Counter(
+    'peer_request_errors_total',
+    'Peer node requests that failed or timed out',
+    labels=('peer', 'operation', 'endpoint'))
+
+CACHE_UPDATES = Histogram(
+    'cache_update_duration_seconds', 'Redis blockchain cache update time')
+
+QUEUE_LENGTH = Gauge(
+    'records_queue_length', 'Transactions queued for forging')
+CHAIN_HEIGHT = Gauge(
+    'blockchain_height', 'Index of the last block in the chain')
+
+REQUESTS = Histogram(
+    'http_request_duration_seconds',
+    'Request time per resource, until the response (or its first chunk '
+    'if streamed) is ready', labels=('endpoint', 'method', 'status'))
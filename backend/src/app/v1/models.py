@@ -1,5 +1,8 @@
 '''This module contains the application models'''
 
+from time import time, sleep
+from pymongo import ReplaceOne, UpdateOne, DeleteMany
+from pymongo.errors import DuplicateKeyError
 from ...plugins import mongo, redis_client
 
 
@@ -11,86 +14,455 @@ class BlockCacheModel:
 
         self.__redis_conn = redis_client
 
-    def push_to_cache(self, transaction_field, transaction_data):
-        '''Pushes updated blockchain transactions to redis cache -> None'''
+    def push_to_cache(self, records, tip_index, removed_fields=(),
+                      tip_hash=None):
+        '''Pushes updated blockchain transactions {field: data} to the redis
+        cache, removes param[removed_fields] and records the index and hash
+        of the last cached block, in a single pipelined transaction -> None'''
 
-        self.__redis_conn.hset(
-            'records_cache', transaction_field, transaction_data)
+        pipe = self.__redis_conn.pipeline(transaction=True)
 
-        self.__redis_conn.persist(transaction_field)
+        if removed_fields:
+            pipe.hdel('records_cache', *removed_fields)
 
-    def pop_from_queue(self, length=False):
-        '''Returns a popped transaction from the Redis queue,
+        if records:
+            pipe.hset('records_cache', mapping=records)
+            pipe.persist('records_cache')
+
+        pipe.set('records_cache_tip', tip_index)
+        self.set_tip_hash(pipe, tip_hash)
+        pipe.execute()
+
+    def set_tip_hash(self, pipe, tip_hash):
+        '''Queues recording the hash of the last cached block on a pipeline,
+        or clearing it if unknown -> None'''
+
+        if tip_hash is None:
+            pipe.delete('records_cache_tip_hash')
+        else:
+            pipe.set('records_cache_tip_hash', tip_hash)
+
+    def rebuild_cache(self, batches, tip_index, tip_hash):
+        '''Rebuilds the redis cache from param[batches] of {field: data}
+        records, written one batch per round trip to a new hash that then
+        replaces the cache, with the index and hash of its last block, in a
+        single transaction -> None'''
+
+        self.__redis_conn.delete('records_cache_rebuild')
+        rebuilt = False
+
+        for batch in batches:
+            self.__redis_conn.hset('records_cache_rebuild', mapping=batch)
+            rebuilt = True
+
+        pipe = self.__redis_conn.pipeline(transaction=True)
+
+        if rebuilt:
+            pipe.rename('records_cache_rebuild', 'records_cache')
+        else:
+            pipe.delete('records_cache')
+
+        pipe.set('records_cache_tip', tip_index)
+        self.set_tip_hash(pipe, tip_hash)
+        pipe.execute()
+
+    def get_cache_state(self):
+        '''Returns the index and hash of the last block added to the cache,
+        None if not recorded -> (int, str)'''
+
+        tip_index, tip_hash = self.__redis_conn.mget(
+            'records_cache_tip', 'records_cache_tip_hash')
+
+        return (int(tip_index) if tip_index else None,
+                tip_hash.decode() if tip_hash else None)
+
+    def get_cache_tip(self):
+        '''Returns the index of the last block added to the cache, defaults
+        to the seed block's index if the cache is empty -> int'''
+
+        tip_index = self.__redis_conn.get('records_cache_tip')
+        return int(tip_index) if tip_index else 1
+
+    def pop_from_queue(self, length=False, batch_size=1, batch_wait=0):
+        '''Returns a batch of popped transactions from the Redis queue,
         otherwise returns its length if param[length] is set to True
-        -> dict or int'''
+        -> list or int
+
+        Once a first transaction is popped, up to param[batch_size] are
+        popped, waiting up to param[batch_wait] ms for the batch to fill.
+        '''
 
         trans_list, list_len = [], 0
 
         if length:
             list_len = self.__redis_conn.llen('records_queue')
         else:
-            trans_list.append(self.__redis_conn.blpop('records_queue', 2))
+            popped = self.__redis_conn.blpop('records_queue', 2)
+
+            if popped is not None:
+                trans_list.append(popped[1])
+                deadline = time() + batch_wait / 1000
+
+                while len(trans_list) < batch_size:
+                    remaining = batch_size - len(trans_list)
 
-            if None in trans_list:
-                trans_list.remove(None)
+                    pipe = self.__redis_conn.pipeline(transaction=True)
+                    pipe.lrange('records_queue', 0, remaining - 1)
+                    pipe.ltrim('records_queue', remaining, -1)
+                    trans_list.extend(pipe.execute()[0])
+
+                    if len(trans_list) >= batch_size or time() >= deadline:
+                        break
+
+                    sleep(max(0, min(0.01, deadline - time())))
 
         return list_len if length else trans_list
 
-    def push_to_queue(self, transaction):
-        '''Pushes a transaction to the front of the queue -> None'''
+    def push_to_queue(self, *transactions):
+        '''Pushes transactions to the front of the queue, in order -> None'''
 
-        self.__redis_conn.lpush('records_queue', transaction)
+        self.__redis_conn.lpush('records_queue', *reversed(transactions))
 
 
 class BlockModel:
     '''Manages the blockchain data in the mongoDB'''
 
+    # Blocks are read without their stored hash, as they are hashed and
+    # sent to peers
+    BLOCK_FIELDS = {'_id': False, 'hash': False}
+
     def __init__(self):
         '''Initializes a collection for block documents in the db'''
 
         self.__db_conn = mongo.db.blocks_collection
+        self.__meta_conn = mongo.db.chain_meta_collection
+
+    def create_indexes(self):
+        '''Creates the block collection's indexes, on bootstrap. Raises
+        DuplicateKeyError if the chain has more than one block at an index
+        -> None'''
+
+        self.__db_conn.create_index('index', unique=True)
+        self.__db_conn.create_index('hash', unique=True, sparse=True)
+        self.__db_conn.create_index('transaction.buyer_id')
+        self.__db_conn.create_index('transactions.buyer_id')
+        self.__db_conn.create_index(
+            [('transaction.plot_num', 1), ('index', -1)])
+        self.__db_conn.create_index(
+            [('transactions.plot_num', 1), ('index', -1)])
+        self.__db_conn.create_index([('date', 1), ('index', 1)])
+
+    def remove_duplicate_blocks(self, hash_block):
+        '''
+        Removes all but one block at each index of the chain, left by
+        concurrent forges of earlier versions -> int the blocks removed
+            1. Indices are repaired in chain order, keeping the block whose
+            previous_hash is param[hash_block](kept block before it), or the
+            first one saved if none is.
+            2. Blocks left that do not follow on are replaced by the next
+            sync, like any invalid suffix.
+        '''
+
+        duplicated = self.__db_conn.aggregate([
+            {'$group': {'_id': '$index', 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+            {'$sort': {'_id': 1}}
+        ])
+        removed = 0
+
+        for index in [group['_id'] for group in duplicated]:
+            previous_block = self.__db_conn.find_one(
+                {'index': index - 1}, {'_id': False})
+            previous_hash = hash_block(previous_block) \
+                if previous_block else None
+            blocks = list(self.__db_conn.find({'index': index}).sort('_id'))
+            kept = next((block for block in blocks
+                         if block.get('previous_hash') == previous_hash),
+                        blocks[0])
+
+            removed += self.__db_conn.delete_many(
+                {'index': index, '_id': {'$ne': kept['_id']}}).deleted_count
+
+        return removed
 
     def block_exists(self, criteria):
         '''Checks if a block in the chain matching the search criteria
         list -> Boolean'''
 
-        cur_obj = self.__db_conn.find(
-            {"transaction.buyer_id": criteria}
-        )
+        return self.__db_conn.find_one(
+            {"$or": [{"transaction.buyer_id": criteria},
+                     {"transactions.buyer_id": criteria}]},
+            {'_id': True}) is not None
+
+    def get_tip(self):
+        '''Returns the chain tip record {index, hash, proof, difficulty,
+        timestamp} of the last block in the chain, or None if it has not
+        been recorded. Legacy blocks have no difficulty or timestamp
+        -> dict'''
+
+        return self.__meta_conn.find_one({'_id': 'chain_tip'}, {'_id': False})
+
+    def set_tip(self, block, block_hash, advance_only=False):
+        '''Records param[block] as the last block in the chain. If
+        param[advance_only] is True, a tip with a higher index is kept
+        -> dict'''
+
+        tip = {
+            'index': block['index'],
+            'hash': block_hash,
+            'proof': block['proof'],
+            'difficulty': block.get('difficulty'),
+            'timestamp': block.get('timestamp')
+        }
+        criteria = {'_id': 'chain_tip'}
+
+        if advance_only:
+            criteria['index'] = {'$lt': block['index']}
+
+        try:
+            self.__meta_conn.update_one(criteria, {'$set': tip}, upsert=True)
+        except DuplicateKeyError:
+            pass
+
+        return tip
 
-        query_result = [document for document in cur_obj]
-        return True if len(query_result) > 0 else False
+    def tip_criteria(self, criteria):
+        '''Limits a blocks query to the blocks up to the chain tip, so that
+        blocks being replaced are never read -> dict'''
 
-    def get_chain(self, length=False):
+        tip = self.get_tip()
+
+        if tip is not None:
+            criteria.setdefault('index', {})['$lte'] = tip['index']
+
+        return criteria
+
+    def get_chain(self, length=False, batch_size=0):
         '''Returns the entire block_chain or it's length if param[length] is
-        set to True -> cursor object or int'''
+        set to True. The cursor fetches param[batch_size] blocks per round
+        trip, if set -> cursor object or int'''
 
         if length:
-            return self.__db_conn.count_documents({})
+            tip = self.get_tip()
+            return tip['index'] if tip else self.__db_conn.count_documents({})
 
         else:
-            return self.__db_conn.find({}, {'_id': False})
+            return self.__db_conn.find(
+                self.tip_criteria({}), self.BLOCK_FIELDS).sort(
+                    'index', 1).batch_size(batch_size)
+
+    def get_block(self, index):
+        '''Returns the block at param[index] -> dict'''
+
+        return self.__db_conn.find_one({"index": index}, self.BLOCK_FIELDS)
+
+    def get_blocks(self, indices):
+        '''Returns the blocks at param[indices] in our chain, in chain order
+        -> cursor object'''
+
+        return self.__db_conn.find(
+            self.tip_criteria({"index": {"$in": list(indices)}}),
+            self.BLOCK_FIELDS).sort('index', 1)
 
-    def persist_new_block(self, new_block):
-        '''Saves a new block to the database -> None'''
+    def get_block_hash(self, index):
+        '''Returns the stored hash of the block at param[index] -> str or
+        None if the block or its hash is missing'''
 
-        self.__db_conn.insert_one(new_block)
+        block = self.__db_conn.find_one({"index": index}, {'hash': True})
+
+        return block.get('hash') if block else None
+
+    def get_block_by_hash(self, block_hash):
+        '''Returns the block in our chain hashing to param[block_hash]
+        -> dict or None'''
+
+        return self.__db_conn.find_one(
+            self.tip_criteria({"hash": block_hash}), self.BLOCK_FIELDS)
+
+    def get_unhashed_blocks(self):
+        '''Returns the blocks saved before block hashes were stored, in chain
+        order -> cursor object'''
+
+        return self.__db_conn.find(
+            {"hash": {"$exists": False}}, {'_id': False}).sort('index', 1)
+
+    def set_block_hashes(self, block_hashes):
+        '''Stores the hashes of blocks {index: hash} -> None'''
+
+        if block_hashes:
+            self.__db_conn.bulk_write([
+                UpdateOne({'index': index}, {'$set': {'hash': block_hash}})
+                for index, block_hash in block_hashes.items()
+            ], ordered=False)
+
+    def get_blocks_since(self, index, batch_size=0):
+        '''Returns the blocks after the block at param[index], in chain
+        order -> cursor object'''
+
+        return self.__db_conn.find(
+            self.tip_criteria({"index": {"$gt": index}}),
+            self.BLOCK_FIELDS).sort('index', 1).batch_size(batch_size)
+
+    def get_blocks_range(self, start_index, limit, date_from=None,
+                         date_to=None):
+        '''Returns up to param[limit] blocks in chain order, from the block at
+        param[start_index] and dated within [date_from, date_to] if set
+        -> list'''
+
+        criteria = {"index": {"$gte": start_index}}
+
+        if date_from or date_to:
+            criteria['date'] = {}
+            if date_from:
+                criteria['date']['$gte'] = date_from
+            if date_to:
+                criteria['date']['$lte'] = date_to
+
+        return list(self.__db_conn.find(
+            self.tip_criteria(criteria), self.BLOCK_FIELDS).sort(
+                'index', 1).limit(limit))
+
+    def get_last_plot_block(self, plot_num, index):
+        '''Returns the last block up to param[index] with a transaction on
+        param[plot_num] -> dict or None'''
+
+        return self.__db_conn.find_one(
+            {"$or": [{"transaction.plot_num": plot_num},
+                     {"transactions.plot_num": plot_num}],
+             "index": {"$lte": index}},
+            self.BLOCK_FIELDS, sort=[('index', -1)])
+
+    def persist_new_block(self, new_block, block_hash=None):
+        '''Saves a new block to the database, with its param[block_hash] if
+        given, advancing the chain tip to it -> None. Raises
+        DuplicateKeyError if the chain already has a block at its index'''
+
+        if block_hash is None:
+            self.__db_conn.insert_one(dict(new_block))
+        else:
+            self.__db_conn.insert_one(dict(new_block, hash=block_hash))
+
+        if block_hash is not None:
+            self.set_tip(new_block, block_hash, advance_only=True)
 
     def get_last_block(self, index=False):
         '''Returns the last block in the chain or it's index, if param[index]
         is set to True -> dict or int'''
 
-        last_index = self.get_chain(True)
+        tip = self.get_tip()
 
-        last_block = self.__db_conn.find_one(
-            {"index": last_index}, {'_id': False})
+        if tip is None:
+            last_block = self.__db_conn.find_one(
+                {}, self.BLOCK_FIELDS, sort=[('index', -1)])
+        else:
+            last_block = self.__db_conn.find_one(
+                {"index": tip['index']}, self.BLOCK_FIELDS)
+
+        if last_block is None:
+            return None
 
         return last_block['index'] if index else last_block
 
+    def replace_blocks(self, fork_block, fork_hash, new_blocks, block_hash):
+        '''
+        Replaces the blocks after param[fork_block] with param[new_blocks],
+        whose last block hashes to param[block_hash] -> None
+            1. The chain tip is first moved back to the fork block (or an
+            empty chain, if None), so readers never see replaced blocks.
+            2. The new blocks are upserted with their hashes and the remaining
+            old ones deleted in a single ordered bulk write. Each block's hash
+            is the previous_hash of the (validated) block after it.
+            3. The chain tip is then moved to the last new block.
+            4. The tip is kept in the chain meta collection, which a bulk
+            write cannot span, and multi document transactions need a
+            replica set. A reorg of our tip block therefore costs three
+            writes, as the bulk write is not atomic for readers either.
+        '''
+
+        fork_index = fork_block['index'] if fork_block else 0
+        tip = self.get_tip()
+
+        if tip is not None and tip['index'] > fork_index:
+            if fork_block:
+                self.set_tip(fork_block, fork_hash)
+            else:
+                self.set_tip({'index': 0, 'proof': None}, None)
+
+        block_hashes = [block['previous_hash'] for block in new_blocks[1:]]
+        block_hashes.append(block_hash)
+
+        operations = [
+            ReplaceOne({'index': block['index']},
+                       dict(block, hash=block_hashes[position]), upsert=True)
+            for position, block in enumerate(new_blocks)
+        ]
+        operations.append(
+            DeleteMany({'index': {'$gt': new_blocks[-1]['index']}}))
+
+        self.__db_conn.bulk_write(operations, ordered=True)
+        self.set_tip(new_blocks[-1], block_hash)
+
     def delete_chain(self):
         '''Deletes all blocks in our chain -> None'''
 
         self.__db_conn.delete_many({})
+        self.__meta_conn.delete_one({'_id': 'chain_tip'})
+
+
+class PlotHistoryModel:
+    '''Manages the plot history index {plot_num, index} of the blocks with
+    transactions on each plot, in the mongoDB'''
+
+    def __init__(self):
+        '''Initializes a collection for plot history entries in the db'''
+
+        self.__db_conn = mongo.db.plot_history_collection
+        self.__meta_conn = mongo.db.chain_meta_collection
+
+    def create_indexes(self):
+        '''Creates the plot history collection's indexes, on bootstrap
+        -> None'''
+
+        self.__db_conn.create_index(
+            [('plot_num', 1), ('index', 1)], unique=True)
+        self.__db_conn.create_index('index')
+
+    def get_history_tip(self):
+        '''Returns the index of the last block added to the plot history,
+        0 if none has been -> int'''
+
+        tip = self.__meta_conn.find_one({'_id': 'plot_history_tip'})
+        return tip['index'] if tip else 0
+
+    def add_entries(self, entries, tip_index):
+        '''Adds the {plot_num, index} param[entries] to the plot history,
+        up to the block at param[tip_index] -> None'''
+
+        if entries:
+            self.__db_conn.bulk_write([
+                UpdateOne(entry, {'$setOnInsert': entry}, upsert=True)
+                for entry in entries
+            ], ordered=False)
+
+        self.__meta_conn.update_one(
+            {'_id': 'plot_history_tip'}, {'$max': {'index': tip_index}},
+            upsert=True)
+
+    def rewind(self, fork_index):
+        '''Removes the entries of the blocks after param[fork_index] -> None'''
+
+        self.__meta_conn.update_one(
+            {'_id': 'plot_history_tip'}, {'$set': {'index': fork_index}},
+            upsert=True)
+        self.__db_conn.delete_many({'index': {'$gt': fork_index}})
+
+    def get_plot_indices(self, plot_num):
+        '''Returns the indices of the blocks with transactions on
+        param[plot_num], in chain order -> list'''
+
+        return [entry['index'] for entry in self.__db_conn.find(
+            {'plot_num': plot_num}, {'_id': False, 'index': True}).sort(
+                'index', 1)]
 
 
 class NodeModel:
@@ -1,27 +1,138 @@
 '''This module contains the app resources'''
 
 import json
-from flask import request
+import zlib
+from datetime import date
+from flask import request, current_app, Response, stream_with_context
 from flask_restful import Resource
-from .controllers import (SecurityController, NodeController,
-                          BlockController, CacheController)
-from ...configs import init_node, public_ip, port
+from .controllers import ForgeWorker, get_controllers
+from . import wire, metrics
+from ...configs import (init_node, public_ip, port, stream_batch_size,
+                        page_size, max_page_size, compression_level)
+
+
+def request_blocks():
+    '''Returns the blocks a peer posted, in any wire format (see wire), or
+    None if the body can not be decoded -> list or dict'''
+
+    try:
+        return wire.load_request(request)
+    except ValueError:
+        return None
+
+
+def stream_chain(cursor, envelope, status_code=200):
+    '''
+    Streams the blocks of param[cursor] in chunks of STREAM_BATCH_SIZE
+    blocks, as they are read from the db -> Response
+        1. By default, as compact JSON with the blocks in the 'payload' of
+        param[envelope].
+        2. As NDJSON (one block per line) if requested with ?format=ndjson
+        or 'Accept: application/x-ndjson'. The envelope's other fields are
+        then sent as 'X-Chain-<Field>' headers.
+        3. As msgpack (the envelope, then each block) if requested with
+        'Accept: application/msgpack' and supported (see wire).
+        4. Compressed with gzip or zlib if the client accepts it.
+    '''
+
+    if request.args.get('format') == 'ndjson':
+        mimetype = wire.NDJSON
+    else:
+        mimetype = wire.negotiate_type(request.accept_mimetypes)
+
+    encoding = wire.negotiate_encoding(request.accept_encodings) \
+        if compression_level else None
+
+    def encode(block):
+        if mimetype == wire.MSGPACK:
+            return wire.dumps(block, mimetype)
+
+        return wire.dumps(block)
+
+    def encode_chunk(batch, first):
+        if mimetype == wire.JSON:
+            return (b'' if first else b',') + b','.join(batch)
+
+        if mimetype == wire.NDJSON:
+            return b'\n'.join(batch) + b'\n'
+
+        return b''.join(batch)
+
+    def generate():
+        batch, first = [], True
+
+        if mimetype == wire.JSON:
+            # The envelope, up to its payload's opening bracket
+            head = wire.dumps(dict(envelope, payload=None))
+            yield head[:-len(b'null}')] + b'['
+
+        elif mimetype == wire.MSGPACK:
+            yield wire.dumps(dict(envelope, streamed=True), mimetype)
+
+        for block in cursor:
+            batch.append(encode(block))
+
+            if len(batch) == stream_batch_size:
+                yield encode_chunk(batch, first)
+                batch, first = [], False
+
+        if batch:
+            yield encode_chunk(batch, first)
+
+        if mimetype == wire.JSON:
+            yield b']}'
+
+    def compress(chunks):
+        # Each chunk is flushed, so that it is sent as soon as it is read
+        compressor = wire.compressor(encoding, compression_level)
+
+        for chunk in chunks:
+            yield compressor.compress(chunk) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        yield compressor.flush()
+
+    headers = {
+        'Vary': 'Accept, Accept-Encoding',
+        'Accept-Post': ', '.join(wire.accepted_types()),
+        'Accept-Encoding': ', '.join(wire.ENCODINGS)
+    }
+
+    if mimetype == wire.NDJSON:
+        headers.update({f'X-Chain-{field.title()}': str(value)
+                        for field, value in envelope.items()})
+
+    body = generate()
+
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        body = compress(body)
+
+    return Response(stream_with_context(body), status=status_code,
+                    headers=headers, mimetype=mimetype)
 
 
 class SystemResource(Resource):
     '''Manages sytem checks requests by the frontend'''
 
+    def get(self):
+        '''Exposes the state of this process' block forge worker -> json'''
+
+        worker = ForgeWorker.get_worker(current_app._get_current_object())
+
+        return {'message': 'Forge worker', 'payload': worker.state()}, 200
+
     def post(self):
         '''Updates both blockchainand node registry on hub initialization'''
 
         payload = 'Blockchain initialized'
         status = 201
 
-        if not init_node:
-            BlockController()
+        controllers = current_app.extensions['controllers'].bootstrap(
+            force=True)
 
-        else:
-            response = BlockController().sync(update_chain=True)
+        if init_node:
+            response = controllers.blocks.sync(update_chain=True)
             if response:
                 payload = 'Backend sync error, contact IT!'
                 status = 500
@@ -45,7 +156,8 @@ class NodeResources(Resource):
             payload = None
 
         else:
-            url = SecurityController().authorize_node(header)
+            controllers = get_controllers()
+            url = controllers.security.authorize_node(header)
 
             if not url:
                 message = 'Unauthorized node'
@@ -53,9 +165,9 @@ class NodeResources(Resource):
                 payload = None
 
             else:
-                NodeController().register_node(url)
+                controllers.nodes.register_node(url)
 
-                node_List = NodeController().extract_nodes()
+                node_List = controllers.nodes.extract_nodes()
                 message = 'Registered_nodes'
                 status_code = 200
                 payload = node_List
@@ -73,9 +185,17 @@ class BlockResources(Resource):
 
     def get(self):
         '''Exposes the protected get entire blockchain endpoint to the peer
-        network -> json'''
+        network -> json.
+
+        A peer sending its last block's index and hash (?since=&tip=) only
+        gets the blocks after it, or a 'diverged_at' marker if our block at
+        that index differs. The blocks are streamed (see stream_chain).
+        '''
 
         header = request.headers
+        since = request.args.get('since', 0, type=int)
+        tip = request.args.get('tip')
+        response = {}
 
         if 'Api-Key' not in header.keys() or 'Url' not in header.keys():
 
@@ -84,33 +204,49 @@ class BlockResources(Resource):
             payload = None
 
         else:
-            url = SecurityController().authorize_node(header)
+            controllers = get_controllers()
+            url = controllers.security.authorize_node(header)
+            blocks = controllers.blocks
 
             if not url:
                 message = 'Unauthorized node'
                 status_code = 401
                 payload = None
 
+            elif since and tip and \
+                    blocks.shares_block(since, tip) is False:
+                controllers.nodes.register_node(url)
+
+                message = 'Chain diverged'
+                status_code = 200
+                payload = []
+                response['diverged_at'] = since
+
             else:
-                blocks = BlockController()
-                NodeController().register_node(url)
+                controllers.nodes.register_node(url)
 
-                result = blocks.extract_chain()
+                if not tip:
+                    since = 0
+
+                cursor = blocks.chain_cursor(since, stream_batch_size)
 
-                if result is None:
+                if cursor is None:
                     message = 'Chain not complete due to pending transactions'
                     status_code = 403
                     payload = []
 
                 else:
-                    message = 'Blockchain'
-                    status_code = 200
-                    payload = result
+                    response['message'] = 'Blockchain'
 
-        response = {
+                    if since:
+                        response['since'] = since
+
+                    return stream_chain(cursor, response)
+
+        response.update({
             'message': message,
             'payload': payload
-        }
+        })
 
         return response, status_code
 
@@ -124,7 +260,6 @@ class BlockResources(Resource):
         '''
 
         header = request.headers
-        data = request.get_json()
 
         if 'Api-Key' not in header.keys() or 'Url' not in header.keys():
 
@@ -132,21 +267,34 @@ class BlockResources(Resource):
             status_code = 400
 
         else:
-            security = SecurityController()
+            controllers = get_controllers()
+            security = controllers.security
             url = security.authorize_node(header)
 
+            # Only authorized peers' bodies are decoded
+            data = request_blocks() if url else None
+
             if not url:
                 message = 'Unauthorized node'
                 status_code = 401
 
+            elif not isinstance(data, list):
+                message = 'Invalid Request'
+                status_code = 400
+
             else:
-                blocks = BlockController()
+                blocks = controllers.blocks
                 result = blocks.extract_chain()
 
+                # Our own chain needs no re-validation
+                if result:
+                    security.checkpoint_block(
+                        result[-1], blocks.blockchain_db.get_block_hash(
+                            result[-1]['index']))
+
                 if len(data) > len(result) and \
                         security.validate_chain(data):
                     blocks.replace_blockchain(data)
-                    CacheController().update_blockchain_cache(data[1:])
 
                     message = f'{public_ip}:{port} Updated'
                     status_code = 201
@@ -162,6 +310,108 @@ class BlockResources(Resource):
         return response, status_code
 
 
+class BlockRangeResource(Resource):
+    '''Manages paginated block range queries'''
+
+    def get(self):
+        '''Exposes the get blocks range endpoint -> json.
+
+        Returns up to ?limit= blocks from the block at ?start=, or after the
+        ?after= cursor returned with the previous page, optionally dated
+        within ?date_from= and ?date_to= (YYYY-MM-DD).
+        '''
+
+        args = request.args
+        start = args.get('start', 1, type=int)
+        after = args.get('after', None, type=int)
+        limit = args.get('limit', page_size, type=int)
+        date_from, date_to = args.get('date_from'), args.get('date_to')
+
+        try:
+            for date_arg in (date_from, date_to):
+                if date_arg:
+                    date.fromisoformat(date_arg)
+
+        except ValueError:
+            return {'message': 'Invalid date, use YYYY-MM-DD'}, 400
+
+        if start < 1 or limit < 1 or (after is not None and after < 0):
+            return {'message': 'Invalid range'}, 400
+
+        if after is not None:
+            start = after + 1
+
+        payload, next_cursor = get_controllers().blocks.get_blocks_page(
+            start, min(limit, max_page_size), date_from, date_to)
+
+        response = {
+            'message': 'Blocks',
+            'payload': payload,
+            'next': next_cursor
+        }
+
+        return response, 200
+
+
+class NewBlockResource(Resource):
+    '''Manages blocks announced by peer hubs'''
+
+    def post(self):
+        '''Exposes the protected append new block endpoint to the peer
+        network -> json.
+
+        A hub that forges a new block sends only that block to all peer
+        hubs. It is appended if it follows our last block, otherwise our
+        blockchain is synced with the peer network.
+        '''
+
+        header = request.headers
+
+        if 'Api-Key' not in header.keys() or 'Url' not in header.keys():
+
+            message = 'Invalid Request'
+            status_code = 400
+
+        else:
+            controllers = get_controllers()
+            security = controllers.security
+            url = security.authorize_node(header)
+
+            # Only authorized peers' bodies are decoded
+            block = request_blocks() if url else None
+
+            if not url:
+                message = 'Unauthorized node'
+                status_code = 401
+
+            elif not isinstance(block, dict):
+                message = 'Invalid Request'
+                status_code = 400
+
+            else:
+                blocks = controllers.blocks
+
+                if blocks.shares_block(block.get('index'),
+                                       security.hash_block(block)):
+                    message = f'{public_ip}:{port} Up to date'
+                    status_code = 200
+
+                elif blocks.append_block(block) or \
+                        not blocks.sync(update_chain=True):
+                    message = f'{public_ip}:{port} Updated'
+                    status_code = 201
+
+                else:
+                    message = f'Error updating {public_ip}:{port}'
+                    status_code = 500
+
+        response = {
+            'message': message,
+        }
+
+        return response, status_code
+
+
 class BlockResource(Resource):
     '''Manages a block resource'''
 
@@ -176,7 +426,8 @@ class BlockResource(Resource):
             'buyer_id': values['buyer_id'],
         }
 
-        result = BlockController().validate_transaction(validation_data)
+        result = get_controllers().blocks.validate_transaction(
+            validation_data)
         message, status_code = '', 0
 
         if result:
@@ -188,24 +439,86 @@ class BlockResource(Resource):
         return message, status_code
 
 
+class BlockHashResource(Resource):
+    '''Manages block lookups by hash'''
+
+    def get(self, block_hash):
+        '''Exposes the get block by hash endpoint -> json'''
+
+        block = get_controllers().blocks.blockchain_db.get_block_by_hash(
+            block_hash)
+
+        if block is None:
+            return {'message': 'Block not found', 'payload': None}, 404
+
+        return {'message': 'Block', 'payload': block}, 200
+
+
+class PlotHistoryResource(Resource):
+    '''Manages plot ownership histories'''
+
+    def get(self, plot_num):
+        '''Exposes the get plot history endpoint, with all transactions on a
+        plot in chain order -> json'''
+
+        history = get_controllers().blocks.plot_history(plot_num)
+
+        if not history:
+            return {'message': 'Plot record not found', 'payload': []}, 404
+
+        return {'message': 'Plot history', 'payload': history}, 200
+
+
+class PlotProofResource(Resource):
+    '''Manages inclusion proofs of plot records'''
+
+    def get(self, plot_num):
+        '''Exposes the get plot record inclusion proof endpoint, so that a
+        plot's record is verified without the entire blockchain (see
+        BlockController.inclusion_proof) -> json'''
+
+        proof = get_controllers().blocks.inclusion_proof(plot_num)
+
+        if proof is None:
+            return {'message': 'Plot record not found', 'payload': None}, 404
+
+        return {'message': 'Inclusion proof', 'payload': proof}, 200
+
+
+class MetricsResource(Resource):
+    '''Manages the backend's metrics'''
+
+    def get(self):
+        '''Exposes this process' forge, sync, cache and request metrics in
+        the Prometheus text format -> text'''
+
+        controllers = get_controllers()
+        tip = controllers.blocks.chain_tip()
+
+        metrics.QUEUE_LENGTH.set(
+            controllers.cache.check_pending_transactions())
+        metrics.CHAIN_HEIGHT.set(tip['index'] if tip else 0)
+
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 class BlockResourcesDemo(Resource):
     '''Demo block resources manager'''
 
     def get(self):
-        '''Exposes the demo get entire blockchain endpoint -> json'''
+        '''Exposes the demo get entire blockchain endpoint, streaming the
+        blockchain (see stream_chain) -> json'''
 
-        blocks = BlockController()
-        result = blocks.extract_chain()
+        blocks = get_controllers().blocks
+        cursor = blocks.chain_cursor(batch_size=stream_batch_size)
 
-        if result is None:
+        if cursor is None:
             message = 'Chain not complete due to pending transactions'
             status_code = 403
             payload = []
 
         else:
-            message = 'Blockchain'
-            status_code = 200
-            payload = result
+            return stream_chain(cursor, {'message': 'Blockchain'})
 
         response = {
             'message': message,
@@ -0,0 +1,231 @@
+'''
+This module traces requests and block forges and writes the backend's logs
+without blocking them on disk I/O:
+    1. Log records are put on an in-memory queue and written to the
+        LOG_FILE file by a background thread, which rotates the file once
+        it reaches LOG_MAX_BYTES.
+    2. A span times a unit of work. Spans opened within a span are its
+        children, so a forge's span holds the time spent syncing, searching
+        for a proof, persisting, caching and broadcasting its block.
+    3. Once a root span (a request or a forge) ends, its trace is logged as
+        one JSON line, if it took at least TRACE_MIN_DURATION_MS.
+'''
+
+import atexit
+import json
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from os import getpid
+from pathlib import Path
+from queue import SimpleQueue
+from threading import Lock
+from time import perf_counter
+from uuid import uuid4
+from ...configs import (log_file, log_max_bytes, log_backups,
+                        trace_min_duration)
+
+LOG_FORMAT = '[%(asctime)s] %(message)s'
+LOG_DATE_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+logger = logging.getLogger('backend')
+trace_logger = logging.getLogger('backend.trace')
+
+# The span the current thread (or request) is in
+_current_span = ContextVar('current_span', default=None)
+
+
+class LogSink(QueueHandler):
+    '''
+    Queues log records for a background thread that writes them to a
+    rotating log file
+        1. The thread is started per process on the first record, so forked
+        server workers each start their own.
+        2. Records still queued are written on exit.
+    '''
+
+    def __init__(self, path, max_bytes, backups):
+        '''Initializes the sink's queue and log file settings'''
+
+        super().__init__(SimpleQueue())
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.listener = None
+        self.listener_pid = None
+        self._lock = Lock()
+
+    def start(self):
+        '''Starts this process' writer thread, if not started -> None'''
+
+        with self._lock:
+            if self.listener_pid == getpid():
+                return
+
+            handler = RotatingFileHandler(
+                self.path, maxBytes=self.max_bytes,
+                backupCount=self.backups, delay=True)
+            handler.setFormatter(
+                logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+
+            self.listener = QueueListener(self.queue, handler)
+            self.listener.start()
+            self.listener_pid = getpid()
+
+            atexit.register(self.stop)
+
+    def stop(self):
+        '''Writes the queued records and stops the writer thread -> None'''
+
+        with self._lock:
+            if self.listener is not None and self.listener_pid == getpid():
+                self.listener.stop()
+                self.listener.handlers[0].close()
+                self.listener, self.listener_pid = None, None
+
+    def prepare(self, record):
+        '''Queues records as they are, so that they are formatted in the
+        writer thread -> LogRecord'''
+
+        return record
+
+    def enqueue(self, record):
+        '''Queues a record, starting the writer thread first -> None'''
+
+        if self.listener_pid != getpid():
+            self.start()
+
+        self.queue.put_nowait(record)
+
+
+def configure_logging(path=None, max_bytes=None, backups=None):
+    '''Sends the backend's logs and traces to a log sink writing
+    param[path] (the LOG_FILE setting by default), once -> LogSink'''
+
+    for handler in logger.handlers:
+        if isinstance(handler, LogSink):
+            return handler
+
+    sink = LogSink(path or Path(log_file).resolve(),
+                   max_bytes if max_bytes is not None else log_max_bytes,
+                   backups if backups is not None else log_backups)
+
+    logger.addHandler(sink)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    return sink
+
+
+class Span:
+    '''A timed unit of work in a trace'''
+
+    __slots__ = ('name', 'attributes', 'trace', 'parent', 'start',
+                 'duration')
+
+    def __init__(self, name, parent=None, **attributes):
+        '''Starts the span, as a child of param[parent] if set'''
+
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.trace = parent.trace if parent else {
+            'id': uuid4().hex, 'spans': []}
+        self.duration = None
+        self.start = perf_counter()
+
+    def set(self, **attributes):
+        '''Adds param[attributes] to the span -> None'''
+
+        self.attributes.update(attributes)
+
+    def end(self):
+        '''Ends the span, logging its trace if it is the root span -> None'''
+
+        self.duration = perf_counter() - self.start
+        self.trace['spans'].append(self)
+
+        if self.parent is None and \
+                self.duration * 1000 >= trace_min_duration:
+            trace_logger.info('trace %s', TraceMessage(self))
+
+
+class TraceMessage:
+    '''Formats a trace as JSON, in the log sink's thread'''
+
+    __slots__ = ('root',)
+
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        start = self.root.start
+
+        return json.dumps({
+            'trace': self.root.trace['id'],
+            'name': self.root.name,
+            'duration_ms': round(self.root.duration * 1000, 3),
+            'attributes': self.root.attributes,
+            'spans': [{
+                'name': span.name,
+                'parent': span.parent.name if span.parent else None,
+                'start_ms': round((span.start - start) * 1000, 3),
+                'duration_ms': round(span.duration * 1000, 3),
+                'attributes': span.attributes
+            } for span in self.root.trace['spans'] if span is not self.root]
+        }, default=str)
+
+
+def current_span():
+    '''Returns the span the caller is in -> Span or None'''
+
+    return _current_span.get()
+
+
+def start_span(name, root=False, **attributes):
+    '''Starts a span as a child of the current span, or of no span if
+    param[root] is True, making it the current span until it is ended with
+    end_span -> Span'''
+
+    span = Span(name, None if root else _current_span.get(), **attributes)
+    _current_span.set(span)
+
+    return span
+
+
+def end_span(span):
+    '''Ends param[span], making its parent the current span. Streamed
+    responses end their span after the request returned, so the parent is
+    restored rather than the context var reset -> None'''
+
+    _current_span.set(span.parent)
+    span.end()
+
+
+@contextmanager
+def span(name, **attributes):
+    '''Traces the with block as a span -> context manager of the Span'''
+
+    current = start_span(name, **attributes)
+
+    try:
+        yield current
+    finally:
+        end_span(current)
+
+
+def traced(name):
+    '''Traces each call of the decorated function as a span -> decorator'''
+
+    def decorate(function):
+
+        @wraps(function)
+        def traced_function(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return traced_function
+
+    return decorate
@@ -0,0 +1,129 @@
+'''
+This module encodes the blocks exchanged with peer nodes:
+    1. Blocks are sent as msgpack when both peers support it (the msgpack
+        package is installed), otherwise as JSON.
+    2. Bodies are compressed with gzip or zlib (HTTP 'deflate') when the
+        other peer accepts it.
+    3. Block hashes are always computed over the canonical JSON of a block
+        (see SecurityController.hash_block), so the wire format does not
+        affect the chain.
+'''
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+NDJSON = 'application/x-ndjson'
+
+# zlib window bits per content encoding, and the smallest body compressed
+ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+MIN_COMPRESSED_SIZE = 1024
+
+# The largest request body decompressed, guarding against zip bombs
+MAX_DECOMPRESSED_SIZE = 256 * 2**20
+
+
+def accepted_types():
+    '''Returns the block content types this node can decode, by
+    preference -> list'''
+
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+
+def accept_header():
+    '''Returns the Accept header value for block requests to peers -> str'''
+
+    return ', '.join(f'{mimetype};q={1 - rank / 10}'
+                     for rank, mimetype in enumerate(accepted_types()))
+
+
+def negotiate_type(accept_mimetypes, offered=(JSON, NDJSON)):
+    '''Returns the best of the param[offered] content types, extended with
+    msgpack if installed, for a request's Accept header -> str'''
+
+    if msgpack is not None:
+        offered = tuple(offered) + (MSGPACK,)
+
+    return accept_mimetypes.best_match(offered, default=JSON) or JSON
+
+
+def negotiate_encoding(accept_encodings):
+    '''Returns the best content encoding (gzip or deflate) for a request's
+    Accept-Encoding header, or None to send an uncompressed body -> str'''
+
+    return accept_encodings.best_match(list(ENCODINGS), default=None)
+
+
+def compressor(encoding, level=6):
+    '''Returns a streaming compressor for param[encoding] -> zlib object'''
+
+    return zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding])
+
+
+def dumps(data, mimetype=JSON):
+    '''Returns param[data] encoded as param[mimetype] -> bytes'''
+
+    if mimetype == MSGPACK:
+        return msgpack.packb(data, use_bin_type=True)
+
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def loads(body, mimetype=JSON, encoding=None):
+    '''Returns the data of a param[mimetype] body, compressed with
+    param[encoding] if set -> object. Raises ValueError if the body can
+    not be decoded'''
+
+    try:
+        if encoding in ENCODINGS:
+            decompressor = zlib.decompressobj(ENCODINGS[encoding])
+            body = decompressor.decompress(body, MAX_DECOMPRESSED_SIZE)
+
+            if decompressor.unconsumed_tail:
+                raise ValueError('Decompressed body too large')
+
+        if mimetype != MSGPACK:
+            return json.loads(body)
+
+        if msgpack is None:
+            raise ValueError('msgpack is not supported')
+
+        unpacker = msgpack.Unpacker(raw=False, max_buffer_size=len(body))
+        unpacker.feed(body)
+        data = list(unpacker)
+
+    except zlib.error as err:
+        raise ValueError(f'Invalid {encoding} body: {err}')
+
+    # A streamed chain is its envelope followed by its blocks
+    if data and isinstance(data[0], dict) and data[0].pop('streamed', False):
+        data[0]['payload'] = data[1:]
+
+    elif len(data) != 1:
+        raise ValueError('Invalid msgpack body')
+
+    return data[0]
+
+
+def load_response(response):
+    '''Returns the data of a peer's block response, in any of the accepted
+    types. requests already decompresses gzip/deflate bodies -> object'''
+
+    mimetype = response.headers.get('Content-Type', JSON).split(';')[0]
+
+    return loads(response.content, mimetype.strip())
+
+
+def load_request(request):
+    '''Returns the data of a peer's request body, in any of the accepted
+    types and content encodings -> object. Raises ValueError if the body
+    can not be decoded'''
+
+    return loads(request.get_data(), request.mimetype or JSON,
+                 request.headers.get('Content-Encoding'))
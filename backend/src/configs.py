@@ -1,6 +1,7 @@
 '''This module fetches and sets up app configurations'''
 
 import os
+import tempfile
 
 testing = os.getenv('TEST')
 init_node = os.getenv('INIT_NODE_IP')
@@ -10,6 +11,56 @@ fe_host = os.getenv('FRONTEND_HOST')
 public_ip = os.getenv('HOST_IP')
 port = os.getenv('HOST_PORT')
 
+# Proof of work search: worker processes (1 searches in-process), the
+# number of proofs each worker checks per task and the kernel searching and
+# verifying proofs (prefix, or the slower reference kernel)
+pow_workers = int(os.getenv('POW_WORKERS', 1))
+pow_chunk_size = int(os.getenv('POW_CHUNK_SIZE', 10000))
+pow_kernel = os.getenv('POW_KERNEL', 'prefix')
+
+# Proof of work difficulty, in leading zero bits of a proof's hash. Blocks
+# are forged at the difficulty and accepted from the minimum difficulty,
+# which all hubs must share. With a retarget interval (blocks, 0 disables
+# it), the difficulty of the blocks after the retarget height is adjusted
+# every interval to forge a block every target block time (s). All hubs
+# must then share these settings too.
+pow_difficulty = int(os.getenv('POW_DIFFICULTY', 16))
+pow_min_difficulty = int(os.getenv('POW_MIN_DIFFICULTY', 16))
+pow_retarget_interval = int(os.getenv('POW_RETARGET_INTERVAL', 0))
+pow_retarget_height = int(os.getenv('POW_RETARGET_HEIGHT', 0))
+pow_target_block_time = float(os.getenv('POW_TARGET_BLOCK_TIME', 10))
+
+# Block forging: the most queued transactions forged into a single block
+# and the time (ms) to wait for a batch to fill up
+forge_batch_size = int(os.getenv('FORGE_BATCH_SIZE', 1))
+forge_batch_wait = int(os.getenv('FORGE_BATCH_WAIT_MS', 0))
+
+# Blockchain responses: the blocks fetched from the db and sent per chunk
+stream_batch_size = int(os.getenv('STREAM_BATCH_SIZE', 500))
+
+# Peer block transfers: gzip/zlib compression level (0 disables it)
+compression_level = int(os.getenv('COMPRESSION_LEVEL', 6))
+
+# Block range queries: the default and largest number of blocks per page
+page_size = int(os.getenv('PAGE_SIZE', 20))
+max_page_size = int(os.getenv('MAX_PAGE_SIZE', 100))
+
+# Peer node requests: connect and read timeouts per request, the deadline
+# for all peers to respond and the number of peers contacted concurrently
+peer_connect_timeout = float(os.getenv('PEER_CONNECT_TIMEOUT', 3))
+peer_read_timeout = float(os.getenv('PEER_READ_TIMEOUT', 10))
+peer_deadline = float(os.getenv('PEER_DEADLINE', 15))
+peer_pool_size = int(os.getenv('PEER_POOL_SIZE', 16))
+
+# Logs: the log file (backend_logs in the working directory, or in the
+# temp dir when testing), the size (bytes) it is rotated at, the rotated
+# files kept and the shortest request or forge trace (ms) logged
+log_file = os.getenv('LOG_FILE', os.path.join(
+    tempfile.gettempdir(), 'backend_logs') if testing else 'backend_logs')
+log_max_bytes = int(os.getenv('LOG_MAX_BYTES', 10 * 2**20))
+log_backups = int(os.getenv('LOG_BACKUPS', 5))
+trace_min_duration = float(os.getenv('TRACE_MIN_DURATION_MS', 500))
+
 mhost = os.getenv('MONGO_DB_HOST')
 muser = os.getenv('MONGO_DB_USER')
 mpassword = os.getenv('MONGO_DB_PASSWORD')
@@ -0,0 +1,343 @@
+'''
+Micro-benchmarks of the backend's hot paths, run against in-process
+stand-ins for Mongo (mongomock) and Redis (fakeredis), installed with
+requirements-dev.txt. From the backend directory:
+
+    python src/tests/v1/benchmarks.py --sizes 10 100 1000 -o results.json
+    python src/tests/v1/benchmarks.py --compare results.json
+
+Results are written as JSON, with the operations per second of benchmarks
+counting them (e.g. hashes per second of the proof of work kernels). With
+--compare, the run fails if a benchmark's median time regressed by more
+than --threshold against the given results.
+The proofs of the synthetic chains are computed once and kept in
+--proofs-file, as they cost a proof of work search per block.
+'''
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parents[3]
+
+BENCHMARKS = {}
+
+
+def benchmark(name, sized=True, operations=None):
+    '''Registers a benchmark, called as benchmark(size, proofs) -> timed
+    function. Benchmarks that are not param[sized] run once, those with
+    param[operations] per run also report operations per second
+    -> decorator'''
+
+    def register(setup):
+        BENCHMARKS[name] = (setup, sized, operations)
+        return setup
+
+    return register
+
+
+# The app is created on import, so its datastores are replaced first. The
+# fixtures are imported from this script's directory, outside the package.
+os.environ.setdefault('TEST', 'benchmark')
+os.environ.setdefault('HOST_IP', 'localhost')
+os.environ.setdefault('HOST_PORT', '5000')
+sys.path.insert(0, str(BACKEND_DIR))
+
+from fixtures import install_stand_ins, synthetic_transaction  # noqa: E402
+
+install_stand_ins()
+
+from src import app  # noqa: E402
+from src.plugins import mongo, redis_client  # noqa: E402
+from src.app.v1.controllers import (BlockController, SecurityController,  # noqa: E402,E501
+                                    NodeController, block_transactions)
+from src.app.v1 import pow_kernels  # noqa: E402
+
+# Proofs hashed per run of the kernel benchmarks
+KERNEL_HASHES = 100000
+
+
+# ------ HELPER FUNCTIONS ------
+def reset_datastores():
+    '''Wipes the stand-in datastores and in-memory chain state -> None'''
+
+    for collection in mongo.db.list_collection_names():
+        mongo.db.drop_collection(collection)
+
+    redis_client.flushall()
+    SecurityController.verified_blocks.clear()
+    NodeController.known_nodes.clear()
+    app.extensions['controllers'].bootstrapped = False
+
+
+def load_proofs(count, proofs_file):
+    '''Returns the first param[count] proofs of a chain from the seed
+    block's proof, at the legacy difficulty, computing and saving the
+    missing ones -> list'''
+
+    proofs_file = Path(proofs_file)
+    proofs = json.loads(proofs_file.read_text()) \
+        if proofs_file.exists() else [100]
+    security = SecurityController()
+
+    if len(proofs) < count:
+        while len(proofs) < count:
+            proofs.append(security.proof_of_work(proofs[-1]))
+
+        proofs_file.write_text(json.dumps(proofs))
+
+    return proofs[:count]
+
+
+def generate_chain(size, proofs, transactions_per_block=1):
+    '''Returns a valid chain of param[size] blocks, forged like
+    BlockController.forge_block does -> list'''
+
+    security = SecurityController()
+    chain = [{
+        'index': 1,
+        'date': '2020-10-08',
+        'transaction': {'seed_block': 'blockchain_initialized'},
+        'proof': proofs[0],
+        'previous_hash': 10
+    }]
+
+    for position in range(1, size):
+        first = (position - 1) * transactions_per_block
+        transactions = [synthetic_transaction(number) for number in
+                        range(first, first + transactions_per_block)]
+        block = {
+            'index': position + 1,
+            'date': '2020-10-08',
+            'timestamp': 1602115200.0 + position,
+            'difficulty': SecurityController.LEGACY_DIFFICULTY,
+            'proof': proofs[position],
+            'previous_hash': security.hash_block(chain[-1])
+        }
+
+        if transactions_per_block > 1:
+            block['transactions'] = transactions
+        else:
+            block['transaction'] = transactions[0]
+
+        block['merkle_root'] = security.merkle_root(block_transactions(block))
+        chain.append(block)
+
+    return chain
+
+
+def load_chain(chain):
+    '''Saves param[chain] as our blockchain -> BlockController'''
+
+    security, blocks = SecurityController(), BlockController()
+
+    for block in chain:
+        blocks.blockchain_db.persist_new_block(
+            block, security.hash_block(block))
+
+    return blocks
+
+
+def time_runs(function, repeat):
+    '''Returns the run times (s) of param[function] -> list'''
+
+    times = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+# ------- BENCHMARKS ----------
+@benchmark('proof_of_work', sized=False)
+def bench_proof_of_work(size, proofs):
+    security = SecurityController()
+    last_proofs = iter(proofs)
+
+    return lambda: security.proof_of_work(next(last_proofs))
+
+
+def bench_kernel(name):
+    '''Returns a run of the param[name] kernel hashing KERNEL_HASHES proofs,
+    at a difficulty no proof meets -> timed function'''
+
+    kernel = pow_kernels.get_kernel(name)
+    difficulty = SecurityController.MAX_DIFFICULTY
+
+    def search():
+        assert kernel.search(100, difficulty, 0, KERNEL_HASHES) is None
+
+    return search
+
+
+@benchmark('pow_kernel_reference', sized=False, operations=KERNEL_HASHES)
+def bench_pow_kernel_reference(size, proofs):
+    return bench_kernel('reference')
+
+
+@benchmark('pow_kernel_prefix', sized=False, operations=KERNEL_HASHES)
+def bench_pow_kernel_prefix(size, proofs):
+    return bench_kernel('prefix')
+
+
+@benchmark('hash_block')
+def bench_hash_block(size, proofs):
+    security = SecurityController()
+    chain = generate_chain(size, proofs)
+
+    def hash_chain():
+        for block in chain:
+            security.hash_block(block)
+
+    return hash_chain
+
+
+@benchmark('validate_chain')
+def bench_validate_chain(size, proofs):
+    security = SecurityController()
+    chain = generate_chain(size, proofs)
+
+    def validate_chain():
+        SecurityController.verified_blocks.clear()
+        assert security.validate_chain(chain)
+
+    return validate_chain
+
+
+@benchmark('extract_chain')
+def bench_extract_chain(size, proofs):
+    blocks = load_chain(generate_chain(size, proofs))
+
+    return blocks.extract_chain
+
+
+@benchmark('update_blockchain_cache')
+def bench_update_blockchain_cache(size, proofs):
+    cache_controller = load_chain(generate_chain(size, proofs)) \
+        .cache_controller
+
+    def update_cache():
+        redis_client.delete('records_cache', 'records_cache_tip')
+        cache_controller.update_blockchain_cache()
+
+    return update_cache
+
+
+@benchmark('forge_block')
+def bench_forge_block(size, proofs):
+    blocks = load_chain(generate_chain(size, proofs))
+    numbers = iter(range(size, 2 * size + 1000))
+
+    # The node has no peers, so the block's index is given to skip the sync
+    def forge_block():
+        number = next(numbers)
+        result = blocks.forge_block(
+            transaction=synthetic_transaction(number),
+            index=blocks.chain_tip()['index'] + 1)
+        assert 'success' in result
+
+    return forge_block
+
+
+def run(names, sizes, repeat, proofs_file):
+    '''Runs the param[names] benchmarks for each chain size -> list'''
+
+    proofs = load_proofs(max(sizes + [repeat]), proofs_file)
+    results = []
+
+    for name in names:
+        setup, sized, operations = BENCHMARKS[name]
+
+        for size in sizes if sized else [None]:
+            reset_datastores()
+
+            with app.app_context():
+                times = time_runs(setup(size or repeat, proofs), repeat)
+
+            results.append({
+                'benchmark': name,
+                'size': size,
+                'repeat': repeat,
+                'min_s': min(times),
+                'median_s': statistics.median(times),
+                'mean_s': statistics.mean(times)
+            })
+
+            if operations:
+                results[-1]['ops_per_s'] = round(
+                    operations / results[-1]['median_s'])
+
+            print(f'{name:<26} size={str(size):<8} '
+                  f'median={results[-1]["median_s"]:.6f}s', file=sys.stderr)
+
+    reset_datastores()
+
+    return results
+
+
+def regressions(results, baseline, threshold):
+    '''Returns the results whose median time is more than param[threshold]
+    slower than the same benchmark's in param[baseline] -> list'''
+
+    base_times = {(result['benchmark'], result['size']): result['median_s']
+                  for result in baseline['results']}
+    slower = []
+
+    for result in results:
+        base_time = base_times.get((result['benchmark'], result['size']))
+
+        if base_time and result['median_s'] > base_time * (1 + threshold):
+            slower.append(dict(result, baseline_median_s=base_time))
+
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        default=list(BENCHMARKS))
+    parser.add_argument('-o', '--output', help='results file, or stdout')
+    parser.add_argument('--compare', help='baseline results file')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--proofs-file', default=str(
+        Path(tempfile.gettempdir()) / 'blockchain_benchmark_proofs.json'))
+    args = parser.parse_args(argv)
+
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': run(args.only, args.sizes, args.repeat, args.proofs_file)
+    }
+    exit_code = 0
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        report['regressions'] = regressions(
+            report['results'], baseline, args.threshold)
+        exit_code = 1 if report['regressions'] else 0
+
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,498 @@
+'''
+Simulates a network of hubs on this machine to measure how block sync
+scales with the number of hubs. From the backend directory:
+
+    python src/tests/v1/cluster.py --nodes 2 5 10 20 --forges 5 -o sync.json
+    python src/tests/v1/cluster.py --nodes 5 --latency-ms 20 --fail-rate 0.02
+    python src/tests/v1/cluster.py --nodes 5 --forges 6 --stop-nodes 1
+
+Each node is a backend subprocess with its own stand-in datastores
+(mongomock and fakeredis), serving the peer API on a local port:
+    1. Nodes join the network like hubs do, through the first (init) node,
+    and then sync their node registries until every node knows every peer.
+    2. Blocks are forged round-robin across the nodes, through the forge
+    worker's queue. After each forge, nodes whose chain tip differs from
+    the forging node's are synced, in rounds, until all tips match.
+    3. Each node delays its peer API responses by --latency-ms and fails
+    them (503) at --fail-rate. With --stop-nodes, that many nodes (never
+    the init node) are stopped after --stop-after forges, the running
+    nodes forging on while their peers are down.
+    4. Each node counts the peer requests it sends and the body bytes sent
+    and received (compressed as sent on the wire). Summed over all nodes,
+    they are the round trips and bytes of a forge.
+Results are written as JSON.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+
+import requests
+
+BACKEND_DIR = Path(__file__).resolve().parents[3]
+
+# Peer traffic sent by this node {round_trips, bytes_sent, bytes_received}
+TRAFFIC = {}
+TRAFFIC_LOCK = Lock()
+
+
+# ------ NODE PROCESS ------
+def reset_traffic():
+    '''Zeroes this node's peer traffic counters -> None'''
+
+    with TRAFFIC_LOCK:
+        TRAFFIC.update(round_trips=0, bytes_sent=0, bytes_received=0)
+
+
+def count_peer_traffic():
+    '''Counts every request this node sends to its peers' API -> None'''
+
+    send = requests.Session.send
+
+    def counted_send(session, request, **kwargs):
+        if '/backend/v1/' not in request.url:
+            return send(session, request, **kwargs)
+
+        with TRAFFIC_LOCK:
+            TRAFFIC['round_trips'] += 1
+            TRAFFIC['bytes_sent'] += len(request.body or b'')
+
+        response = send(session, request, **kwargs)
+
+        with TRAFFIC_LOCK:
+            TRAFFIC['bytes_received'] += \
+                response.raw.tell() or len(response.content)
+
+        return response
+
+    reset_traffic()
+    requests.Session.send = counted_send
+
+
+def serve_node(port):
+    '''Runs a backend node on param[port], with the simulation's control
+    endpoints under /sim. The node's address and init node are set in the
+    environment -> None'''
+
+    # The fixtures are imported from this script's directory, and the app
+    # is created on import, so its datastores are replaced first
+    sys.path.insert(0, str(BACKEND_DIR))
+    from fixtures import install_stand_ins
+
+    install_stand_ins()
+    count_peer_traffic()
+
+    from flask import request, jsonify
+    from src import app
+    from src.app.v1.controllers import get_controllers
+
+    faults = {'latency_ms': 0, 'fail_rate': 0}
+
+    @app.before_request
+    def inject_faults():
+        '''Delays or fails requests to the peer API -> None or response'''
+
+        if not request.path.startswith('/backend/v1/'):
+            return None
+
+        if faults['latency_ms']:
+            time.sleep(faults['latency_ms'] / 1000)
+
+        if random.random() < faults['fail_rate']:
+            return jsonify(message='Injected failure'), 503
+
+    def ping():
+        return jsonify(message='ok')
+
+    def state():
+        controllers = get_controllers()
+        tip = controllers.blocks.chain_tip()
+
+        with TRAFFIC_LOCK:
+            traffic = dict(TRAFFIC)
+
+        return jsonify(
+            tip=tip and {'index': tip['index'], 'hash': tip['hash']},
+            nodes=controllers.nodes.extract_nodes(),
+            traffic=traffic)
+
+    def forge():
+        # Transactions are queued and forged like the forge worker does,
+        # re-queued by failed forges until a later attempt
+        controllers = get_controllers()
+        transaction = request.get_json().get('transaction')
+
+        if transaction:
+            controllers.cache.cache_db.push_to_queue(json.dumps(transaction))
+
+        start = time.perf_counter()
+        result = controllers.cache.fetch_new_transactions()
+
+        return jsonify(result=result, seconds=time.perf_counter() - start)
+
+    def sync():
+        result = get_controllers().blocks.sync(
+            update_chain=request.get_json().get('update_chain', False))
+
+        return jsonify(result=result)
+
+    def set_faults():
+        faults.update(request.get_json())
+
+        return jsonify(faults)
+
+    def clear_traffic():
+        reset_traffic()
+
+        return jsonify(message='ok')
+
+    app.add_url_rule('/sim/ping', 'sim_ping', ping)
+    app.add_url_rule('/sim/state', 'sim_state', state)
+    app.add_url_rule('/sim/forge', 'sim_forge', forge, methods=['POST'])
+    app.add_url_rule('/sim/sync', 'sim_sync', sync, methods=['POST'])
+    app.add_url_rule('/sim/faults', 'sim_faults', set_faults,
+                     methods=['POST'])
+    app.add_url_rule('/sim/traffic/reset', 'sim_traffic_reset',
+                     clear_traffic, methods=['POST'])
+
+    app.run(host='127.0.0.1', port=port, threaded=True, use_reloader=False)
+
+
+# ------ SIMULATION ------
+def free_ports(count):
+    '''Returns param[count] unused local ports -> list'''
+
+    sockets = [socket.socket() for _ in range(count)]
+
+    for sock in sockets:
+        sock.bind(('127.0.0.1', 0))
+
+    ports = [sock.getsockname()[1] for sock in sockets]
+
+    for sock in sockets:
+        sock.close()
+
+    return ports
+
+
+class Cluster:
+    '''A network of local backend nodes, the first being the init node'''
+
+    def __init__(self, size, workdir=None, timeout=120):
+        self.size = size
+        self.workdir = Path(workdir or tempfile.mkdtemp(prefix='cluster-'))
+        self.timeout = timeout
+        self.ports = free_ports(size)
+        self.urls = [f'127.0.0.1:{port}' for port in self.ports]
+        self.processes = []
+        self.session = requests.Session()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        '''Starts the nodes and joins them into a network where every node
+        knows every peer -> None'''
+
+        for position, port in enumerate(self.ports):
+            self.processes.append(self.spawn(position, port))
+
+        for position in range(self.size):
+            self.wait_ready(position)
+
+        # Hubs are initialized through the init node, one at a time
+        for position in range(self.size):
+            self.call(position, 'post', '/backend/v1/init')
+
+        for _ in range(self.size):
+            states = self.states()
+
+            if all(len(state['nodes']) == self.size - 1 for state in states):
+                return
+
+            self.parallel(lambda position: self.call(
+                position, 'post', '/sim/sync', json={'update_chain': False}),
+                range(self.size))
+
+        raise RuntimeError('Node registries did not converge')
+
+    def spawn(self, position, port):
+        '''Starts the node at param[position] on param[port], logging to
+        its own directory -> subprocess.Popen'''
+
+        node_dir = self.workdir / f'node-{position}'
+        node_dir.mkdir(parents=True, exist_ok=True)
+
+        # Forge alerts are sent to a closed local port, failing fast
+        env = dict(os.environ, TEST='cluster', HOST_IP='127.0.0.1',
+                   HOST_PORT=str(port), FRONTEND_HOST='127.0.0.1',
+                   LOG_FILE=str(node_dir / 'backend_logs'))
+        env.pop('INIT_NODE_IP', None)
+
+        if position:
+            env['INIT_NODE_IP'] = self.urls[0]
+
+        log = open(node_dir / 'node.log', 'w')
+
+        return subprocess.Popen(
+            [sys.executable, str(Path(__file__).resolve()),
+             '--serve', str(port)],
+            cwd=node_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, position, timeout=30):
+        '''Waits for the node at param[position] to serve requests -> None'''
+
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            if self.processes[position].poll() is not None:
+                break
+
+            try:
+                self.call(position, 'get', '/sim/ping')
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+        raise RuntimeError(f'Node {position} did not start, see '
+                           f'{self.workdir}/node-{position}/node.log')
+
+    def stop(self, position=None):
+        '''Stops the node at param[position], or all nodes -> None'''
+
+        positions = range(self.size) if position is None else [position]
+
+        for process in [self.processes[pos] for pos in positions
+                        if pos < len(self.processes)]:
+            process.terminate()
+
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def call(self, position, method, path, **kwargs):
+        '''Sends a request to the node at param[position] -> dict'''
+
+        response = self.session.request(
+            method, f'http://{self.urls[position]}{path}',
+            timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+
+        return response.json()
+
+    def parallel(self, function, positions):
+        '''Calls param[function](position) for all param[positions]
+        concurrently -> list'''
+
+        positions = list(positions)
+
+        if not positions:
+            return []
+
+        with ThreadPoolExecutor(max_workers=len(positions)) as executor:
+            return list(executor.map(function, positions))
+
+    def running(self):
+        '''Returns the positions of the nodes still running -> list'''
+
+        return [position for position, process in enumerate(self.processes)
+                if process.poll() is None]
+
+    def states(self):
+        '''Returns the chain tip, peers and traffic of the running nodes
+        -> list'''
+
+        return self.parallel(
+            lambda position: self.call(position, 'get', '/sim/state'),
+            self.running())
+
+    def set_faults(self, latency_ms=0, fail_rate=0):
+        '''Sets the latency and failure rate of all nodes' peer API -> None'''
+
+        self.parallel(lambda position: self.call(
+            position, 'post', '/sim/faults',
+            json={'latency_ms': latency_ms, 'fail_rate': fail_rate}),
+            self.running())
+
+    def forge(self, position, transaction, retries=3, max_rounds=5):
+        '''
+        Forges a block of param[transaction] on the node at param[position]
+        and syncs lagging nodes until all chain tips match -> dict
+            1. A failed forge leaves the transaction queued on the node,
+            which is forged again up to param[retries] times, as the forge
+            worker would.
+            2. Convergence time is from the start of the forge until all
+            running nodes have the forging node's tip.
+            3. Nodes are synced for at most param[max_rounds] rounds.
+        '''
+
+        running = self.running()
+        self.parallel(lambda pos: self.call(pos, 'post', '/sim/traffic/reset'),
+                      running)
+
+        start, attempts, node_forge_s = time.perf_counter(), 0, 0
+        body = {'transaction': transaction}
+
+        while True:
+            attempts += 1
+            forged = self.call(position, 'post', '/sim/forge', json=body)
+            node_forge_s += forged['seconds']
+            forged = 'success' in (forged['result'] or {})
+
+            if forged or attempts > retries:
+                break
+
+            body = {}
+
+        forge_s = time.perf_counter() - start
+        target = self.call(position, 'get', '/sim/state')['tip']['hash']
+        rounds, convergence_s = 0, None
+
+        while True:
+            states = self.states()
+            lagging = [pos for pos, state in zip(running, states)
+                       if (state['tip'] or {}).get('hash') != target]
+
+            if not lagging:
+                convergence_s = time.perf_counter() - start
+                break
+
+            if rounds == max_rounds:
+                break
+
+            rounds += 1
+            self.parallel(lambda pos: self.call(
+                pos, 'post', '/sim/sync', json={'update_chain': True}),
+                lagging)
+
+        traffic = {key: sum(state['traffic'][key] for state in states)
+                   for key in ('round_trips', 'bytes_sent', 'bytes_received')}
+
+        return dict({
+            'node': position,
+            'forged': forged,
+            'attempts': attempts,
+            'forge_s': forge_s,
+            'node_forge_s': node_forge_s,
+            'converged': convergence_s is not None,
+            'convergence_s': convergence_s,
+            'sync_rounds': rounds,
+        }, **traffic)
+
+
+def summarize(forges):
+    '''Returns the medians and means of a cluster's forges -> dict'''
+
+    def median(key):
+        values = [forge[key] for forge in forges if forge[key] is not None]
+        return statistics.median(values) if values else None
+
+    def mean(key):
+        return statistics.mean(forge[key] for forge in forges)
+
+    return {
+        'forges': len(forges),
+        'forged': sum(forge['forged'] for forge in forges),
+        'converged': sum(forge['converged'] for forge in forges),
+        'median_forge_s': median('forge_s'),
+        'median_convergence_s': median('convergence_s'),
+        'mean_attempts': mean('attempts'),
+        'mean_sync_rounds': mean('sync_rounds'),
+        'mean_round_trips': mean('round_trips'),
+        'mean_bytes': mean('bytes_sent') + mean('bytes_received')
+    }
+
+
+def simulate(size, forges, latency_ms=0, fail_rate=0, retries=3,
+             max_rounds=5, workdir=None, stop_nodes=0, stop_after=None):
+    '''Forges param[forges] blocks round-robin on the running nodes of a
+    cluster of param[size] nodes. The last param[stop_nodes] nodes, never
+    the init node, are stopped after param[stop_after] forges (half of them
+    by default) -> dict'''
+
+    from fixtures import synthetic_transaction
+
+    stop_after = forges // 2 if stop_after is None else stop_after
+    stopped = range(max(size - stop_nodes, 1), size)
+    results = []
+
+    with Cluster(size, workdir) as cluster:
+        cluster.set_faults(latency_ms, fail_rate)
+
+        for number in range(forges):
+            if number == stop_after:
+                for position in stopped:
+                    cluster.stop(position)
+
+            running = cluster.running()
+            results.append(dict(cluster.forge(
+                running[number % len(running)], synthetic_transaction(number),
+                retries, max_rounds), running_nodes=len(running)))
+
+    print(f'nodes={size:<4} ' + ' '.join(
+        f'{key}={value:.6g}' if isinstance(value, float) else f'{key}={value}'
+        for key, value in summarize(results).items()), file=sys.stderr)
+
+    return {'nodes': size, 'summary': summarize(results), 'forges': results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[2, 5])
+    parser.add_argument('--forges', type=int, default=5)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--fail-rate', type=float, default=0)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--max-rounds', type=int, default=5)
+    parser.add_argument('--stop-nodes', type=int, default=0)
+    parser.add_argument('--stop-after', type=int,
+                        help='forges before stopping nodes, half by default')
+    parser.add_argument('--workdir', help='node logs, a temp dir by default')
+    parser.add_argument('-o', '--output', help='results file, or stdout')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        return serve_node(args.serve)
+
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency_ms': args.latency_ms,
+        'fail_rate': args.fail_rate,
+        'stop_nodes': args.stop_nodes,
+        'clusters': [
+            simulate(size, args.forges, args.latency_ms, args.fail_rate,
+                     args.retries, args.max_rounds, args.workdir and
+                     Path(args.workdir) / f'nodes-{size}', args.stop_nodes,
+                     args.stop_after)
+            for size in args.nodes]
+    }
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+'''This module contains the stand-in datastores and synthetic data shared by
+the benchmark and cluster simulation scripts. It must not import the app,
+as the stand-ins are installed before the app is created.'''
+
+
+def install_stand_ins():
+    '''Points the app's Mongo and Redis plugins at in-process stand-ins
+    (mongomock and fakeredis), before the app is created -> None'''
+
+    import mongomock
+    import fakeredis
+    import flask_pymongo
+    import flask_redis
+
+    db = mongomock.MongoClient().blockchain_db
+    redis = fakeredis.FakeStrictRedis()
+
+    def init_mongo(self, app, *args, **kwargs):
+        self.cx, self.db = db.client, db
+
+    def init_redis(self, app, **kwargs):
+        self._redis_client = redis
+
+    flask_pymongo.PyMongo.init_app = init_mongo
+    flask_redis.FlaskRedis.init_app = init_redis
+
+
+def synthetic_transaction(number):
+    '''Returns a synthetic land transaction -> dict'''
+
+    return {
+        'plot_num': f'plt{number:08}',
+        'size': '0.25 acres',
+        'location': 'Kangemi',
+        'county': 'Nairobi',
+        'seller_id': 24647567,
+        'buyer_id': 20466890 + number,
+        'buyer_name': f'Buyer{number}',
+        'buyer_tel': '0724679389',
+        'amount': 1500000,
+        'original_owner': 'True'
+    }
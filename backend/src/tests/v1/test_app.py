@@ -1,11 +1,25 @@
 '''This module tests the nodes resources'''
 
+import time
+import zlib
+import hashlib
+import contextvars
+import tempfile
+from pathlib import Path
+from threading import Thread
 import requests
+from unittest import mock, skipIf
 from flask import json
+from pymongo.errors import DuplicateKeyError
 from unittest import TestCase
 from ...plugins import mongo, redis_client
 from .configs import api_key, init_node
 from ... import app
+from ...app.v1.controllers import (CacheController, SecurityController,
+                                   MiningController, BlockController,
+                                   ForgeWorker, get_controllers,
+                                   NodeController, ControllerContainer)
+from ...app.v1 import wire, metrics, tracing, pow_kernels
 from .mock_server import MockServer
 
 
@@ -42,6 +56,76 @@ def reset_test_datastores():
 
     # Redis
     redis_client.expire('records_cache', 0)
+    redis_client.delete('records_cache_tip', 'records_cache_tip_hash')
+    redis_client.delete('records_queue')
+
+    # In-memory chain state, the node is bootstrapped again on next use
+    SecurityController.verified_blocks.clear()
+    NodeController.known_nodes.clear()
+    app.extensions['controllers'].bootstrapped = False
+
+
+def seeded_chain():
+    '''Returns the test node's blockchain, seeding it if the test node is
+    not the init node'''
+
+    chain = BlockController().extract_chain()
+
+    if not chain:
+        chain = [{
+            'index': 1,
+            'date': '2020-10-08',
+            'transaction': {'seed_block': 'blockchain_initialized'},
+            'proof': 100,
+            'previous_hash': 10
+        }]
+        DB.blocks_collection.insert_one(dict(chain[0]))
+
+    return chain
+
+
+def extended_chain(chain, plots):
+    '''Returns a copy of param[chain] extended with a block per
+    (plot_num, buyer_id) of param[plots] -> list'''
+
+    security = SecurityController()
+    chain = [dict(block) for block in chain]
+
+    for plot_num, buyer_id in plots:
+        last_block = chain[-1]
+        chain.append({
+            'index': last_block['index'] + 1,
+            'date': '2020-10-08',
+            'transaction': dict(
+                NEW_TRANSACTION, plot_num=plot_num, buyer_id=buyer_id,
+                buyer_name='Buyer01', buyer_tel='0724679389'),
+            'proof': security.proof_of_work(last_block['proof']),
+            'previous_hash': security.hash_block(last_block)
+        })
+
+    return chain
+
+
+class StubPeer:
+    '''A peer node session answering GET requests with param[respond]
+    (url params) -> (status code, data), after param[delay] seconds'''
+
+    def __init__(self, respond, delay=0):
+        self.respond = respond
+        self.delay = delay
+        self.requests = []
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        self.requests.append({'params': params, 'timeout': timeout})
+        time.sleep(self.delay)
+
+        status_code, data = self.respond(params or {})
+        response = requests.Response()
+        response.status_code, response.reason = status_code, 'Stubbed'
+        response.headers['Content-Type'] = 'application/json'
+        response._content = json.dumps(data).encode()
+
+        return response
 
 
 # ------- TEST CASES ----------
@@ -135,6 +219,25 @@ class TestNodeAuth(TestCase):
                 self.test_auth_blocks, headers=correct_headers)
         self.assertEqual(response.status_code, 200)
 
+        # Keys are compared as bytes, non-ASCII keys are rejected
+        response = TEST_CLIENT.get(self.test_auth_nodes, headers=dict(
+            correct_headers, API_KEY=api_key[:-1] + 'é'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_known_peer_registration(self):
+        '''Tests known peers are registered without registry lookups'''
+
+        nodes = NodeController()
+        nodes.register_node('localhost:5002')
+        self.assertIn('localhost:5002', NodeController.known_nodes)
+        self.assertEqual(1, DB.nodes_collection.count_documents(
+            {'node_url': 'localhost:5002'}))
+
+        # A known peer is not looked up or persisted again
+        DB.nodes_collection.delete_many({})
+        nodes.register_node('localhost:5002')
+        self.assertEqual(0, DB.nodes_collection.count_documents({}))
+
 
 class TestNodeRegistry(TestCase):
     '''Tests inter-peer node registration. Nodes automatically
@@ -432,3 +535,1136 @@ class TestRedisCache(TestCase):
         #                                NEW_TRANSACTION["plot_number"]))
         #     self.assertEqual(cached_record['current_owner'],
         #                      NEW_TRANSACTION['buyer_id'])
+
+
+class TestCacheDeltaUpdate(TestCase):
+    '''Tests the Redis cache is only updated with blocks forged since the
+    last cached block'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_delta_cache_update(self):
+        '''Tests the cached tip advances and only new blocks are cached'''
+
+        cache_controller = CacheController()
+        self.assertEqual(1, cache_controller.cache_db.get_cache_tip())
+
+        for index, plot_num in ((2, 'plt001'), (3, 'plt002')):
+            block_transaction = dict(NEW_TRANSACTION, plot_num=plot_num,
+                                     buyer_name='Buyer01',
+                                     buyer_tel='0724679389')
+            DB.blocks_collection.insert_one({
+                'index': index,
+                'date': '2020-10-08',
+                'transaction': block_transaction,
+                'proof': 100,
+                'previous_hash': 10
+            })
+
+        cache_controller.update_blockchain_cache()
+        self.assertEqual(3, cache_controller.cache_db.get_cache_tip())
+        self.assertEqual(2, redis_client.hlen('records_cache'))
+
+        # Blocks already cached are not re-written
+        redis_client.hdel('records_cache', 'plt001')
+        cache_controller.update_blockchain_cache()
+        self.assertEqual(1, redis_client.hlen('records_cache'))
+
+
+class TestBatchForging(TestCase):
+    '''Tests forging batches of queued transactions into single blocks'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_batch_forging(self):
+        '''Tests a batch of transactions is popped and forged into a block'''
+
+        last_block = seeded_chain()[-1]
+        blocks = BlockController()
+        cache_controller = blocks.cache_controller
+        records = [dict(NEW_TRANSACTION, plot_num=f'plt00{num}',
+                        buyer_id=num, buyer_name='Buyer01',
+                        buyer_tel='0724679389') for num in range(1, 4)]
+
+        for record in records:
+            redis_client.rpush('records_queue', json.dumps(record))
+
+        # Batches are popped in queue order, up to the batch size
+        batch = cache_controller.cache_db.pop_from_queue(batch_size=2)
+        self.assertEqual(
+            records[:2], [json.loads(record.decode()) for record in batch])
+        self.assertEqual(1, cache_controller.cache_db.pop_from_queue(True))
+
+        # The test node has no peers to sync with, so the block's index is
+        # given to forge it without syncing
+        result = blocks.forge_block(transaction=records[:2],
+                                    index=last_block['index'] + 1)
+        self.assertEqual({'success': 'plt001, plt002'}, result)
+
+        block = blocks.blockchain_db.get_last_block()
+        self.assertEqual(records[:2], block['transactions'])
+        self.assertEqual(2, redis_client.hlen('records_cache'))
+        self.assertIsNotNone(blocks.validate_transaction(records[1]))
+
+    @mock.patch('src.app.v1.controllers.forge_batch_size', 4)
+    def test_batch_duplicates(self):
+        '''Tests duplicate buyers of a batch, or of the chain, are dropped
+        and transactions on a plot already in the batch are re-queued'''
+
+        last_block = seeded_chain()[-1]
+        records = [dict(NEW_TRANSACTION, plot_num=f'plt00{num}',
+                        buyer_id=num, buyer_name='Buyer01',
+                        buyer_tel='0724679389') for num in range(1, 5)]
+        resale = dict(records[1], plot_num='plt001')
+
+        for record in (records[0], records[0], resale, records[2]):
+            redis_client.rpush('records_queue', json.dumps(record))
+
+        # The node has no peers to sync with, so forges are stubbed
+        with app.app_context():
+            controllers = get_controllers()
+
+            with mock.patch.object(
+                    controllers.blocks, 'forge_block',
+                    side_effect=lambda transaction: {'forged': transaction}), \
+                    mock.patch('requests.post') as post:
+                result = controllers.cache.fetch_new_transactions()
+
+            self.assertEqual([records[0], records[2]], result['forged'])
+
+            # The frontend is alerted of the dropped duplicate
+            alerts = [call[1]['data'] for call in post.call_args_list]
+            self.assertEqual([{'failure': 'plt001'}, result], alerts)
+            self.assertEqual([resale], [
+                json.loads(record) for record in
+                redis_client.lrange('records_queue', 0, -1)])
+
+            # Transactions forged since they were queued are dropped
+            controllers.blocks.forge_block(transaction=records[0],
+                                           index=last_block['index'] + 1)
+            self.assertEqual(([records[3]], [], [records[0]]),
+                             controllers.blocks.split_batch(
+                                 [records[0], records[3]]))
+
+
+class TestMetrics(TestCase):
+    '''Tests the forge, cache and request metrics endpoint'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_metrics(self):
+        '''Tests forges and requests are recorded in the text format'''
+
+        last_block = seeded_chain()[-1]
+        blocks = BlockController()
+        redis_client.rpush('records_queue', json.dumps(NEW_TRANSACTION))
+
+        forges = metrics.FORGES.series.get(('success',), 0)
+        blocks.forge_block(transaction=dict(
+            NEW_TRANSACTION, plot_num='plt001', buyer_name='Buyer01',
+            buyer_tel='0724679389'), index=last_block['index'] + 1)
+        self.assertEqual(forges + 1, metrics.FORGES.series[('success',)])
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(metrics.CONTENT_TYPE, response.content_type)
+
+        text = response.data.decode()
+        self.assertIn('# TYPE forge_phase_duration_seconds histogram', text)
+        self.assertIn('forge_phase_duration_seconds_count{phase="pow"}', text)
+        self.assertIn('cache_update_duration_seconds_bucket{le="+Inf"}', text)
+        self.assertIn('records_queue_length 1\n', text)
+        self.assertIn(f'blockchain_height {last_block["index"] + 1}\n', text)
+
+        # Histogram buckets are cumulative
+        histogram = metrics.Histogram('test_seconds', 'Test', ('kind',),
+                                      buckets=(1, 2))
+        metrics.REGISTRY.remove(histogram)
+        for value in (0.5, 1.5, 3):
+            histogram.observe(value, kind='a"b')
+        self.assertEqual(['test_seconds_bucket{kind="a\\"b",le="1"} 1',
+                          'test_seconds_bucket{kind="a\\"b",le="2"} 2',
+                          'test_seconds_bucket{kind="a\\"b",le="+Inf"} 3',
+                          'test_seconds_sum{kind="a\\"b"} 5.0',
+                          'test_seconds_count{kind="a\\"b"} 3'],
+                         histogram.samples())
+
+        # The metrics request itself was timed
+        self.assertIn(('v1_bp.metricsresource', 'GET', '200'),
+                      metrics.REQUESTS.series)
+
+
+class TestTracing(TestCase):
+    '''Tests forge and request traces and the background log sink'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    @mock.patch('src.app.v1.tracing.trace_min_duration', 0)
+    def test_forge_trace(self):
+        '''Tests a forge's trace holds the time spent in each phase'''
+
+        last_block = seeded_chain()[-1]
+        blocks = BlockController()
+        transaction = dict(NEW_TRANSACTION, plot_num='plt001',
+                           buyer_name='Buyer01', buyer_tel='0724679389')
+
+        # The test client leaves the requests of streamed responses open,
+        # so the forge is traced in a context of its own
+        with self.assertLogs('backend.trace', level='INFO') as logs:
+            contextvars.Context().run(
+                blocks.forge_block, transaction=transaction,
+                index=last_block['index'] + 1)
+
+        trace = json.loads(logs.records[0].getMessage()[len('trace '):])
+        self.assertEqual('forge_block', trace['name'])
+        self.assertEqual({'index': last_block['index'] + 1,
+                          'result': 'success'}, trace['attributes'])
+
+        phases = [span['name'] for span in trace['spans']
+                  if span['parent'] == 'forge_block']
+        self.assertEqual(['sync', 'pow', 'persist', 'cache'], phases)
+        self.assertLessEqual(
+            sum(span['duration_ms'] for span in trace['spans']
+                if span['parent'] == 'forge_block'), trace['duration_ms'])
+
+        # Requests are traced, with the spans opened while handling them
+        with self.assertLogs('backend.trace', level='INFO') as logs:
+            TEST_CLIENT.get(f'{BASE_URL}/metrics')
+
+        trace = json.loads(logs.records[0].getMessage()[len('trace '):])
+        self.assertEqual('request', trace['name'])
+        self.assertEqual(200, trace['attributes']['status'])
+        self.assertIsNone(tracing.current_span())
+
+    def test_log_sink(self):
+        '''Tests logs are written by the sink's thread and rotated'''
+
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = Path(log_dir)/'backend_logs'
+            sink = tracing.LogSink(path, max_bytes=200, backups=1)
+            logger = tracing.logging.getLogger('backend.test_sink')
+            logger.addHandler(sink)
+            logger.propagate = False
+
+            try:
+                for number in range(10):
+                    logger.warning('Failed to connect to: node%s', number)
+            finally:
+                logger.removeHandler(sink)
+                sink.stop()
+
+            self.assertIn('Failed to connect to: node9', path.read_text())
+            self.assertRegex(path.read_text(),
+                             r'^\[\d{2}-\d{2}-\d{4} [\d:]{8}\] Failed')
+            self.assertTrue((Path(log_dir)/'backend_logs.1').exists())
+            self.assertFalse((Path(log_dir)/'backend_logs.2').exists())
+
+
+class TestForgeWorker(TestCase):
+    '''Tests the long-lived forge worker consuming the transactions queue'''
+
+    def tearDown(self):
+        '''Stops the forge worker and wipes the test datastores'''
+
+        ForgeWorker.get_worker(app).stop(timeout=10)
+        reset_test_datastores()
+
+    def test_forge_worker(self):
+        '''Tests a single worker per process forges queued transactions'''
+
+        seeded_chain()
+        worker = ForgeWorker.get_worker(app)
+        self.assertIs(worker, ForgeWorker.get_worker(app))
+
+        worker.start()
+        worker.start()
+        self.assertTrue(worker.running)
+
+        redis_client.rpush('records_queue', json.dumps(
+            dict(NEW_TRANSACTION, plot_num='plt001', buyer_name='Buyer01',
+                 buyer_tel='0724679389')))
+
+        # The queued transaction is picked up without polling delays
+        deadline = time.time() + 10
+        while worker.last_forge is None and time.time() < deadline:
+            time.sleep(0.05)
+
+        self.assertIn('plt001', worker.last_forge.values())
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/init')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(response.data)['payload']['running'])
+
+        worker.stop(timeout=10)
+        self.assertFalse(worker.running)
+
+
+class TestControllerContainer(TestCase):
+    '''Tests the app's controllers are shared across requests'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_shared_controllers(self):
+        '''Tests controllers are built and the node bootstrapped once'''
+
+        with app.app_context():
+            controllers = get_controllers()
+            self.assertTrue(controllers.bootstrapped)
+            self.assertIs(controllers.blocks, get_controllers().blocks)
+            self.assertIs(controllers.nodes,
+                          controllers.blocks.node_controller)
+            self.assertIs(controllers.security,
+                          controllers.blocks.net_controller.security)
+
+            # Requests do no bootstrap work once the node is bootstrapped
+            DB.blocks_collection.delete_many({})
+            get_controllers()
+            self.assertEqual(0, DB.blocks_collection.count_documents({}))
+
+    def test_bootstrap_retry(self):
+        '''Tests a failed bootstrap is retried on next use'''
+
+        seed_chain, seeds = BlockController.seed_chain, []
+
+        def flaky_seed_chain(blocks):
+            seeds.append(blocks)
+
+            if len(seeds) == 1:
+                raise ConnectionError('db not up yet')
+
+            return seed_chain(blocks)
+
+        with app.app_context(), mock.patch.object(
+                BlockController, 'seed_chain', flaky_seed_chain):
+            controllers = ControllerContainer()
+
+            with self.assertRaises(ConnectionError):
+                controllers.bootstrap()
+
+            self.assertFalse(controllers.bootstrapped)
+            self.assertTrue(controllers.bootstrap().bootstrapped)
+            controllers.bootstrap()
+            self.assertEqual(2, len(seeds))
+
+    def test_concurrent_bootstrap(self):
+        '''Tests requests arriving during the bootstrap wait for it'''
+
+        seed_chain, seeds = BlockController.seed_chain, []
+
+        def slow_seed_chain(blocks):
+            seeds.append(blocks)
+            time.sleep(0.2)
+
+            return seed_chain(blocks)
+
+        def bootstrap():
+            with app.app_context():
+                controllers.bootstrap()
+
+        with app.app_context(), mock.patch.object(
+                BlockController, 'seed_chain', slow_seed_chain):
+            controllers = ControllerContainer()
+            first = Thread(target=bootstrap)
+            first.start()
+            time.sleep(0.05)
+
+            self.assertTrue(controllers.bootstrap().bootstrapped)
+            self.assertEqual(1, len(seeds))
+            first.join()
+
+
+class TestChainStreaming(TestCase):
+    '''Tests the blockchain is streamed out in chunks'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    @mock.patch('src.app.v1.resources.stream_batch_size', 2)
+    def test_chain_streaming(self):
+        '''Tests the streamed chain as compact JSON and NDJSON'''
+
+        chain = seeded_chain()
+        for index in range(2, 6):
+            block = dict(chain[0], index=index, proof=index)
+            DB.blocks_collection.insert_one(dict(block))
+            chain.append(block)
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/blockchain')
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({'message': 'Blockchain', 'payload': chain},
+                         json.loads(response.data))
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/blockchain?format=ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual('Blockchain', response.headers['X-Chain-Message'])
+        self.assertEqual(chain, [json.loads(line) for line in
+                                 response.data.decode().splitlines()])
+
+        # Peers only get the blocks after their tip
+        tip = SecurityController().hash_block(chain[2])
+        response = TEST_CLIENT.get(
+            f'{BASE_URL}/blocks?since=3&tip={tip}',
+            headers={'URL': 'localhost:5002', 'API_KEY': api_key,
+                     'Accept': 'application/x-ndjson'})
+        self.assertEqual('3', response.headers['X-Chain-Since'])
+        self.assertEqual(2, len(response.data.decode().splitlines()))
+
+
+class TestBlockRange(TestCase):
+    '''Tests paginated block range queries'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_block_range_pages(self):
+        '''Tests block pages follow their cursors and date filters'''
+
+        chain = seeded_chain()
+        for index in range(2, 8):
+            block = dict(chain[0], index=index, proof=index,
+                         date=f'2020-10-{index:02}')
+            DB.blocks_collection.insert_one(dict(block))
+            chain.append(block)
+
+        range_url = f'{BASE_URL}/blocks/range'
+        response = TEST_CLIENT.get(f'{range_url}?start=2&limit=4')
+        page = json.loads(response.data)
+        self.assertEqual(chain[1:5], page['payload'])
+        self.assertEqual(5, page['next'])
+
+        response = TEST_CLIENT.get(
+            f'{range_url}?after={page["next"]}&limit=4')
+        page = json.loads(response.data)
+        self.assertEqual(chain[5:], page['payload'])
+        self.assertIsNone(page['next'])
+
+        response = TEST_CLIENT.get(
+            f'{range_url}?date_from=2020-10-03&date_to=2020-10-04')
+        self.assertEqual(chain[2:4], json.loads(response.data)['payload'])
+
+        response = TEST_CLIENT.get(f'{range_url}?date_from=10-2020')
+        self.assertEqual(response.status_code, 400)
+
+
+class TestBlockHashes(TestCase):
+    '''Tests block hashes are stored and blocks looked up by hash'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_block_hash_lookup(self):
+        '''Tests legacy blocks are hashed on bootstrap and found by hash'''
+
+        security = SecurityController()
+        seed = seeded_chain()[0]
+        seed_hash = security.hash_block(seed)
+
+        # Blocks saved without a hash get one when the node bootstraps
+        response = TEST_CLIENT.get(f'{BASE_URL}/block/{seed_hash}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(seed, json.loads(response.data)['payload'])
+        self.assertEqual(seed_hash, DB.blocks_collection.find_one(
+            {'index': 1})['hash'])
+
+        # Stored hashes are neither hashed nor sent to peers
+        blocks = BlockController()
+        self.assertEqual([seed], blocks.extract_chain())
+        self.assertEqual(seed_hash, security.hash_block(
+            dict(seed, hash=seed_hash)))
+        self.assertTrue(blocks.shares_block(1, seed_hash))
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/block/{"0" * 64}')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestInclusionProof(TestCase):
+    '''Tests merkle roots and plot record inclusion proofs'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_plot_inclusion_proof(self):
+        '''Tests a plot record is verified from its proof alone'''
+
+        seed = seeded_chain()[0]
+        security, blocks = SecurityController(), BlockController()
+        records = [dict(NEW_TRANSACTION, plot_num=f'plt00{num}',
+                        buyer_id=num, buyer_name='Buyer01',
+                        buyer_tel='0724679389') for num in range(1, 5)]
+
+        blocks.forge_block(transaction=records[:3], index=2)
+        blocks.forge_block(transaction=records[3], index=3)
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/plots/plt002/proof')
+        self.assertEqual(response.status_code, 200)
+        proof = json.loads(response.data)['payload']
+
+        self.assertEqual(records[1], proof['transaction'])
+        self.assertNotIn('transactions', proof['block'])
+        self.assertTrue(security.verify_merkle_path(
+            proof['transaction'], proof['merkle_path'],
+            proof['block']['merkle_root']))
+        self.assertEqual(security.hash_block(proof['block']),
+                         proof['headers'][0]['previous_hash'])
+        self.assertEqual(blocks.chain_tip()['hash'],
+                         security.hash_block(proof['headers'][-1]))
+
+        # Transactions not under a block's merkle root are rejected
+        chain = blocks.extract_chain()
+        self.assertEqual(seed, chain[0])
+        self.assertTrue(security.validate_chain(chain))
+
+        # Without checkpoints or stored hashes, the tampered chain is
+        # validated from its first block
+        SecurityController.verified_blocks.clear()
+        DB.blocks_collection.update_many({}, {'$unset': {'hash': ''}})
+        chain[1]['transactions'][0] = records[3]
+        self.assertFalse(security.validate_chain(chain))
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/plots/plt009/proof')
+        self.assertEqual(response.status_code, 404)
+
+    def test_duplicated_transactions(self):
+        '''Tests blocks with transactions duplicated to keep their merkle
+        root are rejected'''
+
+        security = SecurityController()
+        records = [dict(NEW_TRANSACTION, plot_num=f'plt00{num}',
+                        buyer_id=num) for num in range(1, 7)]
+
+        for transactions, duplicated in (
+                (records[:3], records[:3] + records[2:3]),
+                (records, records + records[4:])):
+            block = {'transactions': transactions,
+                     'merkle_root': security.merkle_root(transactions)}
+            self.assertTrue(security.validate_merkle_root(block))
+
+            tampered = dict(block, transactions=duplicated)
+            self.assertEqual(block['merkle_root'],
+                             security.merkle_root(duplicated))
+            self.assertEqual(security.hash_block(block),
+                             security.hash_block(tampered))
+            self.assertFalse(security.validate_merkle_root(tampered))
+
+
+class TestPlotHistory(TestCase):
+    '''Tests the plot history index and endpoint'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_plot_history(self):
+        '''Tests a plot's transfers are indexed as blocks are forged'''
+
+        seeded_chain()
+        blocks = BlockController()
+        transfers = [dict(NEW_TRANSACTION, plot_num='plt001', buyer_id=num,
+                          buyer_name=f'Buyer0{num}', buyer_tel='0724679389')
+                     for num in range(1, 4)]
+
+        for index, transfer in enumerate(transfers, 2):
+            blocks.forge_block(transaction=transfer, index=index)
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/plots/plt001/history')
+        self.assertEqual(response.status_code, 200)
+        history = json.loads(response.data)['payload']
+        self.assertEqual(transfers, [entry['transaction']
+                                     for entry in history])
+        self.assertEqual([2, 3, 4], [entry['index'] for entry in history])
+
+        response = TEST_CLIENT.get(f'{BASE_URL}/plots/plt009/history')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestCacheWarmStart(TestCase):
+    '''Tests the Redis cache is brought up to date with the chain tip'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_cache_warm_start(self):
+        '''Tests the cache is kept, replayed or rebuilt on startup'''
+
+        seeded_chain()
+        blocks = BlockController()
+        cache_controller = blocks.cache_controller
+
+        for index, plot_num in ((2, 'plt001'), (3, 'plt002')):
+            blocks.forge_block(index=index, transaction=dict(
+                NEW_TRANSACTION, plot_num=plot_num, buyer_id=index,
+                buyer_name='Buyer01', buyer_tel='0724679389'))
+
+        tip = blocks.chain_tip()
+        self.assertEqual('current', cache_controller.warm_start(tip))
+
+        # A cache of an earlier block only gets the missing blocks
+        redis_client.hdel('records_cache', 'plt001')
+        redis_client.set('records_cache_tip', 2)
+        redis_client.set('records_cache_tip_hash',
+                         blocks.blockchain_db.get_block_hash(2))
+        self.assertEqual('replayed', cache_controller.warm_start(tip))
+        self.assertEqual([b'plt002'], redis_client.hkeys('records_cache'))
+
+        # A flushed cache is rebuilt
+        redis_client.delete('records_cache', 'records_cache_tip',
+                            'records_cache_tip_hash')
+        self.assertEqual('rebuilt', cache_controller.warm_start(tip))
+        self.assertEqual(2, redis_client.hlen('records_cache'))
+        self.assertEqual((3, tip['hash']),
+                         cache_controller.cache_db.get_cache_state())
+
+
+class TestProofOfWork(TestCase):
+    '''Tests the proof of work kernels and parallel search'''
+
+    def test_parallel_proof_of_work(self):
+        '''Tests the mining pool returns the sequential search's proof'''
+
+        security = SecurityController()
+        miner = MiningController(workers=2, chunk_size=1000)
+
+        for last_proof in (100, 35293):
+            proof = miner.proof_of_work(last_proof)
+            self.assertTrue(security.validate_proof(last_proof, proof))
+
+            for smaller_proof in range(proof):
+                self.assertFalse(
+                    security.validate_proof(last_proof, smaller_proof))
+
+    def test_pow_kernels(self):
+        '''Tests the prefix kernel finds and verifies the reference kernel's
+        proofs, across its runs of 100 proofs and range bounds'''
+
+        reference = pow_kernels.get_kernel('reference')
+        prefix = pow_kernels.get_kernel('prefix')
+
+        for last_proof, difficulty in ((100, 16), (35293, 12), (7, 4)):
+            for start, end in ((0, None), (57, 3000), (250, None)):
+                self.assertEqual(
+                    reference.search(last_proof, difficulty, start, end),
+                    prefix.search(last_proof, difficulty, start, end))
+
+        self.assertEqual(35293, prefix.search(100, 16))
+        self.assertIsNone(prefix.search(100, 16, 0, 35293))
+        self.assertIsNone(prefix.search(100, 64, 90, 1000))
+
+        proofs = [(100, 35293, 16), (35293, 35089, 16)]
+        self.assertTrue(prefix.verify_batch(proofs))
+        self.assertFalse(prefix.verify_batch(proofs + [(100, 35294, 16)]))
+
+        with self.assertRaises(ValueError):
+            pow_kernels.get_kernel('gpu')
+
+
+class TestPowDifficulty(TestCase):
+    '''Tests bit-level proof of work difficulty and its retargeting'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_difficulty_bits(self):
+        '''Tests proofs meet a difficulty in leading zero bits, legacy
+        proofs needing 4 leading zero hex digits'''
+
+        security = SecurityController()
+
+        for difficulty in (4, 8, 16):
+            proof = security.proof_of_work(100, difficulty=difficulty)
+            digest = int(hashlib.sha256(f'100{proof}'.encode()).hexdigest(),
+                         16)
+            self.assertEqual(0, digest >> (256 - difficulty))
+
+            for smaller_proof in range(proof):
+                self.assertFalse(security.validate_proof(
+                    100, smaller_proof, difficulty))
+
+        self.assertEqual(35293, security.proof_of_work(100))
+
+    def test_retargeting(self):
+        '''Tests the difficulty is moved every interval towards the target
+        block time, a bit per doubling of the block time'''
+
+        security = SecurityController()
+        first_block = {'index': 2, 'timestamp': 100.0, 'difficulty': 8}
+
+        def next_difficulty(index, timestamp):
+            return security.next_difficulty(
+                {'index': index, 'timestamp': timestamp, 'difficulty': 8},
+                lambda index: dict(first_block, index=index))
+
+        with mock.patch.multiple('src.app.v1.controllers',
+                                 pow_retarget_interval=2,
+                                 pow_target_block_time=1), \
+                mock.patch.object(SecurityController, 'min_difficulty', 1):
+            self.assertEqual(8, next_difficulty(5, 104.0))
+            self.assertEqual(7, next_difficulty(4, 104.0))
+            self.assertEqual(8, next_difficulty(4, 102.0))
+            self.assertEqual(9, next_difficulty(4, 101.0))
+            self.assertEqual(10, next_difficulty(4, 100.0))
+
+            # Legacy blocks are not retargeted from
+            self.assertEqual(16, security.next_difficulty(
+                {'index': 4, 'proof': 100}, lambda index: None))
+
+            # Blocks up to the retarget height are forged at POW_DIFFICULTY
+            with mock.patch('src.app.v1.controllers.pow_retarget_height', 5):
+                self.assertEqual(16, next_difficulty(4, 100.0))
+                self.assertEqual(8, next_difficulty(5, 104.0))
+
+        self.assertEqual(16, next_difficulty(4, 104.0))
+
+        # Retargeting never goes below the minimum difficulty
+        with mock.patch.multiple('src.app.v1.controllers',
+                                 pow_retarget_interval=2,
+                                 pow_target_block_time=1):
+            self.assertEqual(16, next_difficulty(4, 104.0))
+
+    @mock.patch.object(SecurityController, 'min_difficulty', 8)
+    def test_difficulty_validation(self):
+        '''Tests blocks must meet the difficulty they were forged at, from
+        the minimum difficulty, whatever difficulty hubs forge at'''
+
+        security, blocks = SecurityController(), BlockController()
+        last_block = seeded_chain()[-1]
+
+        with mock.patch('src.app.v1.controllers.pow_difficulty', 8):
+            for number in (1, 2):
+                blocks.forge_block(transaction=dict(
+                    NEW_TRANSACTION, plot_num=f'plt00{number}',
+                    buyer_id=number, buyer_name='Buyer01',
+                    buyer_tel='0724679389'),
+                    index=last_block['index'] + number)
+
+        chain = blocks.extract_chain()
+        self.assertEqual([8, 8], [block['difficulty']
+                                  for block in chain[-2:]])
+
+        # Peer chains are checked after the blocks they share with ours
+        peer_chain = json.loads(json.dumps(chain[:-1]))
+
+        for tampered in (dict(chain[-1], difficulty=4),
+                         dict(chain[-1], difficulty=20),
+                         dict(chain[-1], timestamp=time.time() + 3600),
+                         {key: value for key, value in chain[-1].items()
+                          if key != 'difficulty'}):
+            peer_chain.append(tampered)
+            self.assertFalse(security.validate_chain(peer_chain))
+            peer_chain.pop()
+
+        # Hubs forging at another difficulty, or retargeting from a later
+        # height, still accept the chain
+        reset_test_datastores()
+
+        with mock.patch.multiple('src.app.v1.controllers',
+                                 pow_difficulty=20, pow_retarget_interval=1,
+                                 pow_retarget_height=chain[-1]['index']):
+            self.assertTrue(security.validate_chain(chain))
+
+        # Hubs requiring a higher minimum difficulty reject it
+        with mock.patch.object(SecurityController, 'min_difficulty', 16):
+            self.assertFalse(security.validate_chain(chain))
+
+
+class TestChainTip(TestCase):
+    '''Tests the recorded chain tip and the blockchain's db indexes'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_tip_record(self):
+        '''Tests the tip only moves back when not advancing only, a stale
+        tip being ignored'''
+
+        blockchain_db = BlockController().blockchain_db
+        self.assertIsNone(blockchain_db.get_tip())
+
+        blockchain_db.set_tip({'index': 3, 'proof': 30}, 'hash3')
+        self.assertEqual({'index': 3, 'hash': 'hash3', 'proof': 30,
+                          'difficulty': None, 'timestamp': None},
+                         blockchain_db.get_tip())
+
+        # A stale tip, e.g. from a forge that lost a race, is ignored
+        blockchain_db.set_tip({'index': 2, 'proof': 20}, 'hash2',
+                              advance_only=True)
+        blockchain_db.set_tip({'index': 3, 'proof': 31}, 'other3',
+                              advance_only=True)
+        self.assertEqual('hash3', blockchain_db.get_tip()['hash'])
+
+        blockchain_db.set_tip(
+            {'index': 4, 'proof': 40, 'difficulty': 16, 'timestamp': 4.0},
+            'hash4', advance_only=True)
+        self.assertEqual({'index': 4, 'hash': 'hash4', 'proof': 40,
+                          'difficulty': 16, 'timestamp': 4.0},
+                         blockchain_db.get_tip())
+
+        # Reorganizations move the tip back
+        blockchain_db.set_tip({'index': 2, 'proof': 20}, 'hash2')
+        self.assertEqual('hash2', blockchain_db.get_tip()['hash'])
+
+    def test_duplicate_blocks(self):
+        '''Tests duplicate blocks at an index are removed to create the
+        chain's unique index, keeping the block that follows on'''
+
+        blocks = BlockController()
+        chain = extended_chain(seeded_chain(), (('plt001', '1'),))
+        stray_block = dict(chain[1], previous_hash='stray', proof=1)
+
+        for block in (stray_block, chain[1], dict(stray_block)):
+            DB.blocks_collection.insert_one(dict(block))
+
+        blocks.create_indexes()
+        self.assertEqual(chain, blocks.extract_chain())
+
+        with self.assertRaises(DuplicateKeyError):
+            DB.blocks_collection.insert_one(dict(stray_block))
+
+
+class TestChainValidation(TestCase):
+    '''Tests incremental validation of chains sharing our chain's blocks'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_checkpointed_validation(self):
+        '''Tests only blocks after our last verified block are trusted from
+        a peer's chain'''
+
+        security = SecurityController()
+        blocks = BlockController()
+        chain = seeded_chain()
+
+        for index, plot_num in ((2, 'plt001'), (3, 'plt002'), (4, 'plt003')):
+            last_block = chain[-1]
+            chain.append({
+                'index': index,
+                'date': '2020-10-08',
+                'transaction': dict(NEW_TRANSACTION, plot_num=plot_num,
+                                    buyer_name='Buyer01',
+                                    buyer_tel='0724679389'),
+                'proof': security.proof_of_work(last_block['proof']),
+                'previous_hash': security.hash_block(last_block)
+            })
+
+        # Our chain holds the first three blocks
+        blocks.replace_blockchain(json.loads(json.dumps(chain[:3])))
+        self.assertTrue(security.validate_chain(chain))
+
+        # A peer's chain is only trusted after the blocks it shares with ours
+        peer_chain = json.loads(json.dumps(chain))
+        peer_chain[1]['transaction']['buyer_id'] = 'tampered'
+        blocks.replace_blockchain(peer_chain)
+
+        new_chain = blocks.extract_chain()
+        self.assertEqual(4, len(new_chain))
+        self.assertEqual(NEW_TRANSACTION['buyer_id'],
+                         new_chain[1]['transaction']['buyer_id'])
+
+    def test_stale_checkpoints(self):
+        '''Tests checkpoints of blocks another process has since replaced
+        in our chain are not trusted'''
+
+        security = SecurityController()
+        blocks = BlockController()
+
+        old_chain = extended_chain(
+            seeded_chain(), (('plt001', '1'), ('plt002', '2')))
+        blocks.replace_blockchain(json.loads(json.dumps(old_chain)))
+        self.assertTrue(security.validate_chain(old_chain))
+        stale_checkpoints = SecurityController.verified_blocks.copy()
+
+        # Another process reorganizes blocks 2 and 3, its checkpoints
+        # being its own
+        our_chain = extended_chain(
+            old_chain[:1], (('plt003', '3'), ('plt004', '4')))
+        blocks.replace_blockchain(json.loads(json.dumps(our_chain)))
+        SecurityController.verified_blocks.clear()
+        SecurityController.verified_blocks.update(stale_checkpoints)
+
+        peer_chain = extended_chain(
+            old_chain, (('plt005', '5'), ('plt006', '6')))
+        self.assertEqual(0, security.verified_position(peer_chain))
+        self.assertTrue(security.validate_chain(peer_chain))
+
+        blocks.replace_blockchain(json.loads(json.dumps(peer_chain)))
+        self.assertEqual(peer_chain, blocks.extract_chain())
+
+        SecurityController.verified_blocks.clear()
+        self.assertTrue(security.validate_chain(blocks.extract_chain()))
+
+    def test_chain_reorganization(self):
+        '''Tests only the blocks after the fork are replaced and the
+        cached records of replaced blocks are restored'''
+
+        security = SecurityController()
+        blocks = BlockController()
+
+        our_chain = extended_chain(
+            seeded_chain(), (('plt001', '1'), ('plt002', '2')))
+        blocks.replace_blockchain(json.loads(json.dumps(our_chain)))
+
+        # The peer chain forks after our second block
+        SecurityController.verified_blocks.clear()
+        peer_chain = extended_chain(
+            our_chain[:2], (('plt003', '3'), ('plt004', '4')))
+        self.assertTrue(security.validate_chain(peer_chain))
+        self.assertEqual(2, blocks.find_fork_index(peer_chain))
+
+        blocks.replace_blockchain(json.loads(json.dumps(peer_chain)))
+        self.assertEqual(peer_chain, blocks.extract_chain())
+
+        cached_plots = {plot_num.decode() for plot_num in
+                        redis_client.hkeys('records_cache')}
+        self.assertEqual({'plt001', 'plt003', 'plt004'}, cached_plots)
+
+        # Replaced blocks are removed from the plot history
+        self.assertEqual([], blocks.history_db.get_plot_indices('plt002'))
+        self.assertEqual([3], blocks.history_db.get_plot_indices('plt003'))
+
+
+class TestPeerRequests(TestCase):
+    '''Tests blocks are requested from stubbed peers concurrently and only
+    after our tip, unless a peer's chain diverged from ours'''
+
+    def setUp(self):
+        '''Stores a two block chain as ours'''
+
+        self.blocks = BlockController()
+        self.chain = extended_chain(seeded_chain(), (('plt001', '1'),))
+        self.blocks.replace_blockchain(json.loads(json.dumps(self.chain)))
+        self.peers = {}
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def request_blocks(self):
+        '''Requests the blocks after our tip from the stubbed peers
+        -> dict'''
+
+        network = self.blocks.net_controller
+        tip_block = self.blocks.extract_chain()[-1]
+
+        with mock.patch.object(network, 'get_session', self.peers.get):
+            return network.request_data(
+                list(self.peers), 'blocks', len(self.chain), tip_block)
+
+    def chain_peer(self, chain, delay=0):
+        '''Returns a peer serving param[chain] like the blocks resource
+        -> StubPeer'''
+
+        def respond(params):
+            if 'since' not in params:
+                return 200, {'payload': chain}
+
+            since = params['since']
+
+            if SecurityController().hash_block(chain[since - 1]) != \
+                    params['tip']:
+                return 200, {'payload': [], 'diverged_at': since}
+
+            return 200, {'payload': chain[since:], 'since': since}
+
+        return StubPeer(respond, delay)
+
+    def test_peer_ahead(self):
+        '''Tests a peer ahead of us only sends the blocks after our tip'''
+
+        peer_chain = extended_chain(self.chain, (('plt002', '2'),))
+        self.peers['localhost:5002'] = self.chain_peer(peer_chain)
+
+        result = self.request_blocks()
+        self.assertEqual(peer_chain[2:], result['payload'])
+        self.assertEqual(2, result['since'])
+        self.assertEqual([], result['error_nodes'])
+
+        params = self.peers['localhost:5002'].requests[0]['params']
+        self.assertEqual(2, params['since'])
+        self.assertEqual(
+            SecurityController().hash_block(self.chain[-1]), params['tip'])
+
+    def test_diverged_peer(self):
+        '''Tests the entire chain of a peer that diverged from ours is
+        requested and returned'''
+
+        peer_chain = extended_chain(
+            self.chain[:1], (('plt003', '3'), ('plt004', '4')))
+        self.peers['localhost:5002'] = self.chain_peer(peer_chain)
+
+        result = self.request_blocks()
+        self.assertEqual(peer_chain, result['payload'])
+        self.assertEqual(0, result['since'])
+
+        first, second = self.peers['localhost:5002'].requests
+        self.assertEqual(2, first['params']['since'])
+        self.assertIsNone(second['params'])
+
+    @mock.patch('src.app.v1.controllers.peer_deadline', 0.5)
+    def test_slow_peers(self):
+        '''Tests peers are waited for until the peer deadline, including
+        the entire chain requests of diverged peers'''
+
+        ahead_chain = extended_chain(self.chain, (('plt002', '2'),))
+        diverged_chain = extended_chain(
+            self.chain[:1], (('plt003', '3'), ('plt004', '4')))
+        self.peers['localhost:5002'] = self.chain_peer(ahead_chain, 1.5)
+        self.peers['localhost:5003'] = self.chain_peer(ahead_chain)
+        self.peers['localhost:5004'] = self.chain_peer(diverged_chain, 0.3)
+
+        start = time.perf_counter()
+        result = self.request_blocks()
+        self.assertLess(time.perf_counter() - start, 1.5)
+
+        # The responsive peer's blocks are used, the others timed out
+        self.assertEqual(ahead_chain[2:], result['payload'])
+        self.assertEqual(['Failed to connect to: localhost:5002',
+                          'Failed to connect to: localhost:5004'],
+                         [node['message'] for node in result['error_nodes']])
+
+        # The diverged peer's second request only got what was left of the
+        # deadline
+        diverged_requests = self.peers['localhost:5004'].requests
+        self.assertEqual(2, len(diverged_requests))
+        self.assertLessEqual(diverged_requests[1]['timeout'][0], 0.2)
+        self.assertLessEqual(diverged_requests[1]['timeout'][1], 0.2)
+
+
+class TestNewBlock(TestCase):
+    '''Tests appending of single blocks announced by peer nodes'''
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_new_block_append(self):
+        '''Tests a block following our last block is appended'''
+
+        peer_headers = {
+            'URL': 'localhost:5002',
+            'API_KEY': api_key,
+            "Content-Type": "application/json"
+        }
+
+        security = SecurityController()
+        last_block = seeded_chain()[-1]
+        new_block = {
+            'index': last_block['index'] + 1,
+            'date': '2020-10-08',
+            'transaction': dict(NEW_TRANSACTION, plot_num='plt001',
+                                buyer_name='Buyer01', buyer_tel='0724679389'),
+            'proof': security.proof_of_work(last_block['proof']),
+            'previous_hash': security.hash_block(last_block)
+        }
+
+        response = TEST_CLIENT.post(f'{BASE_URL}/blocks/new',
+                                    headers=peer_headers,
+                                    data=json.dumps(new_block))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(2, DB.blocks_collection.count_documents({}))
+
+        # An already appended block is not added again
+        response = TEST_CLIENT.post(f'{BASE_URL}/blocks/new',
+                                    headers=peer_headers,
+                                    data=json.dumps(new_block))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(2, DB.blocks_collection.count_documents({}))
+
+
+class TestWireFormat(TestCase):
+    '''Tests the negotiated encoding of blocks exchanged with peers'''
+
+    def setUp(self):
+        '''Setup before each test'''
+
+        self.peer_headers = {
+            'URL': 'localhost:5002',
+            'API_KEY': api_key
+        }
+
+    def tearDown(self):
+        '''Wipes the test datastores after each test'''
+
+        reset_test_datastores()
+
+    def test_compressed_chain_transfer(self):
+        '''Tests compressed chains and blocks decode to the same blocks'''
+
+        chain = seeded_chain()
+        response = TEST_CLIENT.get(f'{BASE_URL}/blocks', headers=dict(
+            self.peer_headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertIn(wire.JSON, response.headers['Accept-Post'])
+
+        data = json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS))
+        self.assertEqual(chain, data['payload'])
+
+        # Posted blocks are decoded from the encoding the peer accepts
+        security = SecurityController()
+        new_block = {
+            'index': chain[-1]['index'] + 1,
+            'date': '2020-10-08',
+            'transaction': dict(NEW_TRANSACTION, plot_num='plt001',
+                                buyer_name='Buyer01', buyer_tel='0724679389'),
+            'proof': security.proof_of_work(chain[-1]['proof']),
+            'previous_hash': security.hash_block(chain[-1])
+        }
+        compressor = wire.compressor('deflate')
+        response = TEST_CLIENT.post(
+            f'{BASE_URL}/blocks/new',
+            data=compressor.compress(wire.dumps(new_block)) +
+            compressor.flush(),
+            headers=dict(self.peer_headers, **{
+                'Content-Type': wire.JSON, 'Content-Encoding': 'deflate'}))
+        self.assertEqual(response.status_code, 201)
+
+        response = TEST_CLIENT.post(
+            f'{BASE_URL}/blocks/new', data=b'\x00garbage',
+            headers=dict(self.peer_headers, **{
+                'Content-Type': wire.JSON, 'Content-Encoding': 'gzip'}))
+        self.assertEqual(response.status_code, 400)
+
+    @skipIf(wire.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_chain_transfer(self):
+        '''Tests a msgpack chain stream decodes to the chain'''
+
+        chain = seeded_chain()
+        response = TEST_CLIENT.get(f'{BASE_URL}/blocks', headers=dict(
+            self.peer_headers, Accept=wire.accept_header()))
+        self.assertEqual(wire.MSGPACK, response.mimetype)
+        self.assertEqual(chain, wire.loads(
+            response.data, wire.MSGPACK)['payload'])